@@ -21,20 +21,78 @@ __author__ = 'gsherman'
 
 import os
 import sys
-import subprocess
+import collections
+import contextlib
 import shutil
+import struct
+import threading
+import time
+import zlib
 import errno
+import functools
 import glob
-import urllib.request
-import urllib.error
-import configparser
-from string import Template
-from distutils.dir_util import copy_tree
-import pkgutil
-import webbrowser
+import hashlib
+import json
+import re
 
 import click
 
+# Modules that are slow to import (subprocess, zipfile, configparser,
+# concurrent.futures, urllib, webbrowser, PyQt5...) are imported by the
+# functions that use them so commands like version and list start quickly
+
+# Written into the deployed plugin to record what was copied, so a repeat
+# deploy only has to copy what changed
+MANIFEST_NAME = '.pb_tool_manifest.json'
+MANIFEST_VERSION = 1
+
+# Seconds watch waits for things to settle after a change
+WATCH_DEBOUNCE = 0.2
+
+# Per project state kept between runs, relative to the project directory
+CACHE_DIR = '.pb_tool_cache'
+
+# The help documentation laid out as in the Plugin Builder template, and
+# the fingerprint of the help directory it was last built from
+DOCS_SOURCE = os.path.join('help', 'source')
+DOCS_OUTPUT = os.path.join('help', 'build', 'html')
+DOCS_STATE = os.path.join(CACHE_DIR, 'docs.json')
+
+# Held while PyQt5.uic compiles a form: it keeps module level state too
+UIC_LOCK = threading.Lock()
+
+# Files with these extensions are stored in the zip package without trying
+# to deflate them; other files above SAMPLE_THRESHOLD bytes are sampled to
+# see if deflating them is worthwhile (e.g. compressed GeoTIFFs)
+COMPRESSED_EXTENSIONS = frozenset([
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.jp2', '.ecw', '.sid',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.zst', '.laz', '.pbf',
+    '.mp3', '.mp4', '.ogg', '.webm'])
+SAMPLE_THRESHOLD = 1024 * 1024
+
+# Sizes, offsets and counts past these need the zip64 extensions (the
+# limits zipfile uses)
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX_FILES = (1 << 16) - 1
+
+# Files copied at once when deploying; copying is mostly waiting on the
+# file system, so this is not tied to the number of CPUs
+COPY_JOBS = 16
+
+# How byte-compiled files are checked against their source when imported
+PYC_INVALIDATION = ('timestamp', 'checked-hash', 'unchecked-hash')
+
+# External tools pb_tool can use, with the argument that makes each print
+# its version (None: run it without arguments)
+TOOLS = collections.OrderedDict([
+    ('pyuic5', '--version'),
+    ('pyrcc5', '-version'),
+    ('lrelease', '-version'),
+    ('lrelease-qt4', '-version'),
+    ('sphinx-build', '--version'),
+    ('make', '--version'),
+    ('zip', '-v'),
+    ('7z', None)])
 
 class AliasedGroup(click.Group):
     def get_command(self, ctx, cmd_name):
@@ -52,7 +110,27 @@ class AliasedGroup(click.Group):
 
 #@click.group()
 @click.command(cls=AliasedGroup)
-def cli():
+@click.option('--profile',
+              is_flag=True,
+              help='Report the time spent and bytes processed by each stage '
+                   'and the slowest files')
+@click.option('--profile-top',
+              type=click.IntRange(min=1),
+              default=10,
+              help='Number of files listed by --profile (default: 10)')
+@click.option('--trace',
+              type=click.Path(dir_okay=False),
+              default=None,
+              help='Write the profile to this file in Chrome trace event '
+                   'format (implies --profile)')
+@click.option('--workspace', '-w',
+              type=click.Path(exists=True),
+              default=None,
+              help='Run compile, deploy or zip for every plugin of a '
+                   'workspace: a workspace config file, or a directory whose '
+                   '*/pb_tool.cfg plugins are used')
+@click.pass_context
+def cli(ctx, profile, profile_top, trace, workspace):
     """Simple Python tool to compile and deploy a QGIS plugin.
     For help on a command use --help after the command:
     pb_tool deploy --help.
@@ -68,7 +146,159 @@ def cli():
     Bugs and enhancement requests, see:
         https://github.com/g-sherman/plugin_build_tool
     """
-    pass
+    global PROFILER
+    command = ctx.invoked_subcommand and \
+        ctx.command.get_command(ctx, ctx.invoked_subcommand)
+    if workspace and command:
+        if command.name not in WORKSPACE_COMMANDS:
+            ctx.fail('{0} can\'t be used with --workspace (use {1})'.format(
+                command.name, ', '.join(WORKSPACE_COMMANDS)))
+        ctx.obj = Workspace(workspace)
+    if profile or trace:
+        PROFILER = Profiler()
+        span = PROFILER.span(command.name if command else 'pb_tool')
+        span.__enter__()
+
+        def report():
+            global PROFILER
+            span.__exit__(None, None, None)
+            PROFILER.report(profile_top)
+            if trace:
+                PROFILER.write_trace(trace)
+                click.secho("Wrote the trace to {0}".format(trace),
+                            fg='green')
+            PROFILER = None
+        ctx.call_on_close(report)
+
+
+# The Profiler recording the current command when --profile is given
+PROFILER = None
+
+
+def profiled(name, category='stage'):
+    """
+    Context manager timing a stage of a command, or the work on a single
+    file, when profiling. It yields a dict; setting its 'bytes' item
+    records the number of bytes processed.
+    """
+    if PROFILER is None:
+        return contextlib.nullcontext({})
+    return PROFILER.span(name, category)
+
+
+def profiled_stage(name):
+    """ Decorator profiling every call of a function as the stage name """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiled(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Profiler(object):
+    """
+    Records wall and CPU time and bytes processed for the stages of a
+    command and the files they work on, from any thread.
+
+    Stages are charged the CPU time of the whole process including child
+    processes that finished and the bytes of the files processed while they
+    ran; files the CPU time of the thread doing the work.
+    """
+    def __init__(self):
+        self.events = []
+        self.stages = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category='stage'):
+        record = {}
+        stage = category == 'stage'
+        cpu = self.process_cpu if stage else time.thread_time
+        if stage:
+            with self.lock:
+                self.stages.append(record)
+        start, start_cpu = time.perf_counter(), cpu()
+        try:
+            yield record
+        finally:
+            event = {'name': name, 'cat': category,
+                     'start': start - self.origin,
+                     'wall': time.perf_counter() - start,
+                     'cpu': cpu() - start_cpu,
+                     'tid': threading.get_ident()}
+            with self.lock:
+                if stage:
+                    self.stages = [open_stage for open_stage in self.stages
+                                   if open_stage is not record]
+                elif record.get('bytes'):
+                    # the stages running count the bytes of their files
+                    for open_stage in self.stages:
+                        open_stage['bytes'] = open_stage.get('bytes', 0) + \
+                            record['bytes']
+                event['bytes'] = record.get('bytes')
+                self.events.append(event)
+
+    @staticmethod
+    def process_cpu():
+        times = os.times()
+        return time.process_time() + times.children_user + \
+            times.children_system
+
+    def report(self, top=10):
+        """ Print the stages in the order they ran and the slowest files """
+        stages = sorted((event for event in self.events
+                         if event['cat'] == 'stage'),
+                        key=lambda event: event['start'])
+        files = sorted((event for event in self.events
+                        if event['cat'] != 'stage'),
+                       key=lambda event: event['wall'], reverse=True)
+        click.secho("\nProfile", fg='green')
+
+        def row(name, wall, cpu, size):
+            print('{0:<40} {1:>9} {2:>9} {3:>10}'.format(
+                name, wall, cpu, size).rstrip())
+
+        def event_row(name, event):
+            if len(name) > 40:
+                name = '...' + name[-37:]
+            row(name, '{0:.3f}'.format(event['wall']),
+                '{0:.3f}'.format(event['cpu']),
+                '' if event['bytes'] is None else format_size(event['bytes']))
+
+        row('Stage', 'Wall s', 'CPU s', 'Bytes')
+        for event in stages:
+            event_row(event['name'], event)
+        if files:
+            print("")
+            row('Slowest {0} of {1} files'.format(min(top, len(files)),
+                                                  len(files)),
+                'Wall s', 'CPU s', 'Bytes')
+            for event in files[:top]:
+                event_row('{0} {1}'.format(event['cat'], event['name']),
+                          event)
+
+    def write_trace(self, path):
+        """
+        Write the events in Chrome's trace event format, which
+        chrome://tracing and Perfetto load
+        """
+        pid = os.getpid()
+        events = []
+        for event in sorted(self.events, key=lambda event: event['start']):
+            args = {'cpu_ms': round(event['cpu'] * 1000, 3)}
+            if event['bytes'] is not None:
+                args['bytes'] = event['bytes']
+            events.append({'name': event['name'], 'cat': event['cat'],
+                           'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                           'ts': round(event['start'] * 1e6, 1),
+                           'dur': round(event['wall'] * 1e6, 1),
+                           'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                      indent=1)
 
 
 def __version():
@@ -77,15 +307,438 @@ def __version():
     return ("3.0.6", "2017-11-05")
 
 
-def get_install_files(cfg):
-    python_files = cfg.get('files', 'python_files').split()
-    main_dialog = cfg.get('files', 'main_dialog').split()
-    extras = cfg.get('files', 'extras').split()
-    # merge the file lists
-    install_files = python_files + main_dialog + compiled_ui(
-        cfg) + compiled_resource(cfg) + extras
-    #click.echo(install_files)
-    return install_files
+class Project(object):
+    """
+    A plugin project as declared in its config file. The config is parsed
+    and the file lists are split once when the project is loaded; the
+    plugin directory and external tools are resolved the first time they
+    are needed. Every command works from a single Project.
+
+    File names in the config are relative to root, the current directory
+    unless given, so projects can be built side by side without changing
+    directory. Projects can share the dict of tools they found.
+    """
+    __slots__ = ('config', 'root', 'cfg', 'name', 'python_files',
+                 'main_dialog', 'compiled_ui_files', 'resource_files',
+                 'extras', 'extra_dirs', 'locales', 'help_dir', 'help_target',
+                 'excludes', 'compiled_ui', 'compiled_resource',
+                 'translation_files',
+                 'compiled_translations', 'install_files', '_plugin_paths',
+                 '_tools', '_index')
+
+    def __init__(self, config='pb_tool.cfg', plugin_path=None, root='',
+                 tools=None):
+        self.config = config
+        self.root = root
+        self.cfg = cfg = get_config(config)
+        self._index = None
+        self.excludes = ExcludeRules.from_config(cfg, config)
+        self.name = cfg.get('plugin', 'name', fallback=None)
+        self.python_files = self.file_list('python_files', '.py')
+        self.main_dialog = self.file_list('main_dialog', '.ui')
+        self.compiled_ui_files = self.file_list('compiled_ui_files', '.ui')
+        self.resource_files = self.file_list('resource_files', '.qrc')
+        self.extras = self.file_list('extras', '')
+        self.extra_dirs = self.file_list('extra_dirs')
+        self.locales = self.file_list('locales')
+        self.help_dir = cfg.get('help', 'dir', fallback=None)
+        self.help_target = cfg.get('help', 'target', fallback=None)
+        self.compiled_ui = compiled_names(self.compiled_ui_files)
+        self.compiled_resource = compiled_names(self.resource_files)
+        # locales name .ts files in the i18n directory, with or without
+        # their extension
+        self.translation_files = [
+            os.path.join('i18n', '{0}.ts'.format(os.path.splitext(locale)[0]))
+            for locale in self.locales]
+        self.compiled_translations = compiled_names(self.translation_files,
+                                                    '.qm')
+        # merge the file lists
+        self.install_files = (self.python_files + self.main_dialog +
+                              self.compiled_ui + self.compiled_resource +
+                              self.extras + self.compiled_translations)
+        # one directory or several, given on the command line
+        if isinstance(plugin_path, str):
+            plugin_path = [plugin_path]
+        self._plugin_paths = [path for path in plugin_path or () if path]
+        self._tools = {} if tools is None else tools
+
+    def file_list(self, option, extension=None):
+        """
+        The names listed as option in the [files] section. Glob patterns
+        (** matching any number of directories) are expanded and, if
+        extension is given, so are directories: to the files below them
+        ending with extension. Both are resolved from the project's index.
+        """
+        names = []
+        for name in self.cfg.get('files', option, fallback='').split():
+            if re.search(r'[*?[]', name):
+                names += self.index.glob(name)
+            elif extension is not None and os.path.isdir(self.path(name)):
+                names += self.index.below(name, extension)
+            else:
+                names.append(name)
+        # patterns and directories may overlap each other and plain names
+        seen = set()
+        unique = []
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                unique.append(name)
+        return unique
+
+    @property
+    def index(self):
+        """ The SourceIndex of the project, made when first needed """
+        if self._index is None:
+            self._index = SourceIndex(self.root, self.excludes)
+        return self._index
+
+    def path(self, name):
+        """ The path of name, a file name relative to the project root """
+        return os.path.join(self.root, name) if self.root else name
+
+    @property
+    def plugin_paths(self):
+        """
+        The directories plugins are deployed to: as given on the command
+        line, configured in pb_tool.cfg (relative to the project root) or
+        the QGIS profiles'; empty if they can't be determined
+        """
+        if not self._plugin_paths:
+            self._plugin_paths = [self.path(path) for path
+                                  in get_plugin_directories(self.cfg)]
+        return self._plugin_paths
+
+    @property
+    def plugin_path(self):
+        """ The first directory plugins are deployed to, or None """
+        paths = self.plugin_paths
+        return paths[0] if paths else None
+
+    @property
+    def plugin_dirs(self):
+        """ The directories the plugin is deployed to """
+        if not self.name:
+            return []
+        return [os.path.join(path, self.name) for path in self.plugin_paths]
+
+    @property
+    def plugin_dir(self):
+        """ The first directory the plugin is deployed to, or None """
+        plugin_dirs = self.plugin_dirs
+        return plugin_dirs[0] if plugin_dirs else None
+
+    def tool(self, name):
+        """ The path of an external tool, looked up once """
+        if name not in self._tools:
+            self._tools[name] = check_path(name)
+        return self._tools[name]
+
+
+def compiled_names(sources, extension='.py'):
+    """ Return the names of the files the sources compile to """
+    compiled = []
+    for source in sources:
+        (base, ext) = os.path.splitext(source)
+        compiled.append(base + extension)
+    return compiled
+
+
+class SourceIndex(object):
+    """
+    The files below a project directory, listed by a single os.scandir
+    walk, that glob patterns and directories in the file lists are
+    resolved from. Hidden files and directories and __pycache__ are left
+    out, as is everything excludes (an ExcludeRules) excludes; links to
+    directories are not followed.
+    """
+    __slots__ = ('root', 'files')
+
+    def __init__(self, root='', excludes=None):
+        self.root = root
+        files = []
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            try:
+                entries = os.scandir(os.path.join(root or os.curdir, rel_dir))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or \
+                            entry.name == '__pycache__':
+                        continue
+                    name = '{0}/{1}'.format(rel_dir, entry.name) \
+                        if rel_dir else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not (excludes and
+                                    excludes.excluded(name, True)):
+                                pending.append(name)
+                        elif entry.is_file():
+                            if not (excludes and excludes.excluded(name)):
+                                files.append(name)
+                    except OSError:
+                        pass
+        # '/' separated names, sorted
+        self.files = sorted(files)
+
+    def glob(self, pattern):
+        """ The files matching a glob pattern, as file names """
+        regex = glob_regex(pattern.replace(os.sep, '/'))
+        return [name.replace('/', os.sep) for name in self.files
+                if regex.match(name)]
+
+    def below(self, directory, extension=''):
+        """ The files below directory ending with extension """
+        prefix = directory.replace(os.sep, '/').strip('/') + '/'
+        return [name.replace('/', os.sep) for name in self.files
+                if name.startswith(prefix) and name.endswith(extension)]
+
+
+class ExcludeRules(object):
+    """
+    Patterns with .gitignore semantics for files that are never deployed
+    or packaged, from exclude in the [files] section (for the whole
+    project) and the [exclude] section (for the directory each option
+    names, like a .gitignore in it). A pattern with a / other than at the
+    end is anchored to its directory, otherwise it matches at any depth; a
+    trailing / only matches directories, ! re-includes what an earlier
+    pattern excluded and the last matching pattern wins. Paths are '/'
+    separated and relative to the project root.
+    """
+    __slots__ = ('rules',)
+
+    def __init__(self, patterns=None):
+        self.rules = []
+        # the patterns of deeper directories take precedence
+        for directory in sorted(patterns or {},
+                                key=lambda name: name.count('/')
+                                if name else -1):
+            for pattern in patterns[directory]:
+                negate = pattern.startswith('!')
+                pattern = pattern.lstrip('!')
+                dir_only = pattern.endswith('/')
+                pattern = pattern.rstrip('/')
+                if not pattern:
+                    continue
+                if '/' not in pattern:
+                    pattern = '**/' + pattern
+                self.rules.append((directory, glob_regex(pattern.lstrip('/')),
+                                   negate, dir_only))
+
+    @classmethod
+    def from_config(cls, cfg, config):
+        patterns = {'': cfg.get('files', 'exclude', fallback='').split()}
+        if cfg.has_section('exclude'):
+            import configparser
+            # read the section again keeping the case of the option names,
+            # which are directories
+            raw = configparser.ConfigParser(interpolation=None)
+            raw.optionxform = str
+            raw.read(config)
+            for directory, value in raw.items('exclude'):
+                directory = directory.replace(os.sep, '/').strip('/')
+                patterns.setdefault(directory, []).extend(value.split())
+        return cls(patterns)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def excluded(self, path, is_dir=False):
+        """ Return True if path (a directory if is_dir) is excluded """
+        excluded = False
+        for directory, regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if directory:
+                if not path.startswith(directory + '/'):
+                    continue
+                name = path[len(directory) + 1:]
+            else:
+                name = path
+            if regex.match(name):
+                excluded = not negate
+        return excluded
+
+
+def glob_regex(pattern):
+    """
+    Compile a glob pattern for '/' separated names: * and ? don't match a
+    '/', [...] is a character class ([!...] negated) and ** matches any
+    number of directories
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:[^/]*/)*')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[{0}]'.format(chars.replace('\\', '\\\\')))
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(regex) + r'\Z')
+
+
+# The commands that can be run for every plugin of a workspace
+WORKSPACE_COMMANDS = ('compile', 'deploy', 'zip')
+
+
+class Workspace(object):
+    """
+    The plugins built together with --workspace: the directories or config
+    files listed as plugins in the [workspace] section of a workspace
+    config file, relative to it, or the */pb_tool.cfg found next to it (or
+    in the directory given instead of a file).
+
+    Every plugin is built in its own directory without changing the
+    current one. Up to jobs (default: [workspace] jobs or the number of
+    CPUs) plugins are built at once, each with its own pools sized to its
+    share of jobs.
+    """
+    def __init__(self, path):
+        import configparser
+        cfg = configparser.ConfigParser()
+        # absolute, so building the plugins never depends on the current
+        # directory
+        if os.path.isdir(path):
+            root = os.path.abspath(path)
+        else:
+            root = os.path.dirname(os.path.abspath(path))
+            cfg.read(path)
+        self.jobs = cfg.getint('workspace', 'jobs', fallback=None)
+        plugins = cfg.get('workspace', 'plugins', fallback='').split()
+        if plugins:
+            self.configs = []
+            for plugin in plugins:
+                config = os.path.join(root, plugin)
+                if os.path.isdir(config):
+                    config = os.path.join(config, 'pb_tool.cfg')
+                if not os.path.isfile(config):
+                    raise click.UsageError(
+                        'The workspace plugin {0} has no config file '
+                        '{1}'.format(plugin, config))
+                self.configs.append(os.path.normpath(config))
+        else:
+            self.configs = sorted(
+                os.path.normpath(config) for config in glob.glob(
+                    os.path.join(glob.escape(root), '*', 'pb_tool.cfg')))
+            if not self.configs:
+                raise click.UsageError(
+                    'No plugins were found in the workspace {0}'.format(path))
+
+    def run(self, command, jobs, build, plugin_path=()):
+        """
+        Call build(project, jobs) for every plugin concurrently, jobs being
+        the plugin's share, and report the plugins as they finish, each with
+        everything printed while it was built. Exits with status 1 if build
+        returned False for any of them.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        jobs = jobs or self.jobs or os.cpu_count()
+        workers = min(jobs, len(self.configs))
+        # the tools are looked up once for all plugins
+        tools = find_tools()
+        # relative to the current directory, like the workspace
+        plugin_path = [os.path.abspath(path) for path in plugin_path if path]
+        projects = [Project(config, plugin_path,
+                            root=os.path.dirname(config), tools=tools)
+                    for config in self.configs]
+
+        def build_plugin(project):
+            with profiled(project.name or project.root):
+                # the plugins built at once share the jobs between them
+                return build(project, max(1, jobs // workers))
+
+        output = ThreadOutput(sys.stdout)
+        sys.stdout = output
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = dict((pool.submit(output.capture, build_plugin,
+                                            project), project)
+                               for project in projects)
+                for future in as_completed(futures):
+                    project = futures[future]
+                    built, text = future.result()
+                    if not built:
+                        failed.append(project.name or project.root)
+                    click.secho('==> {0} ({1})'.format(
+                        project.name, project.root),
+                        fg='green' if built else 'red', file=output.stream)
+                    output.stream.write(text)
+        finally:
+            sys.stdout = output.stream
+        if failed:
+            click.secho('{0} failed for {1} of {2} plugins: {3}'.format(
+                command, len(failed), len(projects), ', '.join(
+                    sorted(failed))), fg='red')
+            sys.exit(1)
+        click.secho('{0} succeeded for {1} plugins'.format(
+            command, len(projects)), fg='green')
+
+
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout, collecting what a thread prints while it
+    runs capture so the output of plugins built at the same time isn't
+    mixed up. Other threads write to stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self, function, *args):
+        """ Call function, returning its result and what it printed """
+        import io
+        self.local.buffer = buffer = io.StringIO()
+        try:
+            result = function(*args)
+        except Exception as oops:
+            buffer.write('Error: {0}\n'.format(oops))
+            result = False
+        finally:
+            self.local.buffer = None
+        return result, buffer.getvalue()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer or self.stream).write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        if getattr(self.local, 'buffer', None) is None:
+            return self.stream.isatty()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def current_workspace():
+    """ The Workspace given with --workspace, or None """
+    ctx = click.get_current_context(silent=True)
+    return ctx.find_object(Workspace) if ctx else None
 
 
 @cli.command()
@@ -99,8 +752,10 @@ def version():
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
 @click.option('--plugin_path', '-p',
-              default=None,
-              help='Specify the directory where to deploy your plugin if not using the standard location')
+              multiple=True,
+              help='Specify the directory where to deploy your plugin if not '
+                   'using the standard location; repeat it to deploy to '
+                   'several directories')
 @click.option('--quick', '-q',
               is_flag=True,
               help='Do a quick install without compiling ui, resource, docs, \
@@ -108,111 +763,420 @@ def version():
 @click.option('--no-confirm', '-y',
               is_flag=True,
               help='Don\'t ask for confirmation to overwrite existing files')
-def deploy(config, plugin_path, quick, no_confirm):
+@click.option('--jobs', '-j',
+              type=click.IntRange(min=1),
+              default=None,
+              help='Number of files to compile or copy in parallel (default: '
+                   'number of CPUs for compiling, 16 for copying)')
+@click.option('--link',
+              type=click.Choice(['symlink', 'hardlink']),
+              is_flag=False, flag_value='symlink', default=None,
+              help='Link the files into the plugin directory instead of '
+                   'copying them, so edits show up in QGIS right away '
+                   '(symlink unless hardlink is given)')
+@click.option('--bytecode', '-b',
+              is_flag=True,
+              help='Byte-compile the Python files so the plugin starts '
+                   'without compiling anything (see [bytecode] in the '
+                   'config for the optimization levels and how the .pyc '
+                   'files are checked)')
+def deploy(config, plugin_path, quick, no_confirm, jobs, link, bytecode):
     """Deploy the plugin to QGIS plugin directory using parameters in pb_tool.cfg"""
-    deploy_files(config, plugin_path, quick=quick, confirm=not no_confirm)
-
-
-def deploy_files(config, plugin_path, confirm=True, quick=False):
-    """Deploy the plugin using parameters in pb_tool.cfg"""
+    workspace = current_workspace()
+    if workspace:
+        if not (quick or no_confirm or click.confirm(
+                "Compile, build and deploy {0} plugins?".format(
+                    len(workspace.configs)))):
+            return
+        # copying waits on the file system rather than the CPU, so each
+        # plugin keeps its own copying threads
+        workspace.run('deploy', jobs, lambda project, jobs: deploy_files(
+            project, confirm=False, quick=quick, jobs=jobs, link=link,
+            bytecode=bytecode, copy_jobs=COPY_JOBS), plugin_path)
+        return
     # check for the config file
     if not os.path.exists(config):
         click.secho("Configuration file {0} is missing.".format(config),
                     fg='red')
-    else:
-        cfg = get_config(config)
-        if not plugin_path:
-            plugin_path = get_plugin_directory(config)
-            if not plugin_path:
-                click.secho("Unable to determine where to deploy your plugin", fg='red')
-                return
+        return
+    deploy_files(Project(config, plugin_path), quick=quick,
+                 confirm=not no_confirm, jobs=jobs, link=link,
+                 bytecode=bytecode)
 
-        plugin_dir = os.path.join(plugin_path, cfg.get('plugin', 'name'))
 
-        click.secho("Deploying to {}".format(plugin_dir), fg='green')
+def deploy_files(project, confirm=True, quick=False, jobs=None, link=None,
+                 bytecode=False, copy_jobs=None):
+    """
+    Deploy the plugin using parameters in pb_tool.cfg. With several plugin
+    directories everything is compiled and built once and the files are
+    copied to all of them in one pass, by copy_jobs threads (default:
+    jobs). The Python files are byte-compiled if bytecode is set or
+    configured. Returns True if the plugin was deployed.
+    """
+    bytecode = bytecode_options(project.cfg, bytecode)
+    plugin_dirs = project.plugin_dirs
+    if not plugin_dirs:
+        click.secho("Unable to determine where to deploy your plugin", fg='red')
+        return False
+    else:
+        for plugin_dir in plugin_dirs:
+            click.secho("Deploying to {}".format(plugin_dir), fg='green')
         if quick:
             click.secho("Doing quick deployment", fg='green')
-            install_files(plugin_dir, cfg)
-            click.secho(
-                "Quick deployment complete---if you have problems with your"
-                " plugin, try doing a full deploy.",
-                fg='green')
+            if staged_install(project, jobs=jobs, link=link,
+                              bytecode=bytecode, copy_jobs=copy_jobs):
+                click.secho(
+                    "Quick deployment complete---if you have problems with your"
+                    " plugin, try doing a full deploy.",
+                    fg='green')
+                return True
+            return False
 
         else:
             if confirm:
                 print("""Deploying will:
-                * Remove your currently deployed version
-                * Compile the ui and resource files
+                * Compile the ui, resource and translation files
                 * Build the help docs
-                * Copy everything to your {} directory
-                """.format(plugin_dir))
+                * Copy new and changed files to a staging copy of your {} directory
+                * Remove deployed files that are no longer in your config
+                * Swap the staged plugin in, keeping the current one for rollback
+                """.format(', '.join(plugin_dirs)))
 
                 proceed = click.confirm("Proceed?")
             else:
                 proceed = True
 
             if proceed:
-                # clean the deployment
-                clean_deployment(False, config)
-                click.secho("Deploying to {0}".format(plugin_dir), fg='green')
                 # compile to make sure everything is fresh
                 click.secho('Compiling to make sure install is clean',
                             fg='green')
-                compile_files(cfg)
-                build_docs()
-                install_files(plugin_dir, cfg)
+                if compile_files(project, jobs):
+                    click.secho("Compilation failed---the plugin was not "
+                                "deployed", fg='red')
+                    return False
+                if not build_docs(jobs, root=project.root):
+                    click.secho("The plugin was not deployed", fg='red')
+                    return False
+                return staged_install(project, jobs=jobs, link=link,
+                                      bytecode=bytecode, copy_jobs=copy_jobs)
+            return False
+
+
+def staged_install(project, jobs=None, link=None, bytecode=None,
+                   copy_jobs=None):
+    """
+    Install the plugin into a staging directory next to each plugin
+    directory and swap them in once everything is in place, so QGIS never
+    sees a half written plugin. The deployments they replace are kept for
+    rollback. If files could not be written the deployed plugins are left
+    as they were. Files are copied by copy_jobs threads (default: jobs).
+    Returns True if the new version was swapped in everywhere.
+
+    Staging needs hard links to be cheap; plugin directories on file
+    systems without them (FAT, many SMB shares) are updated in place.
+
+    With bytecode (see bytecode_options) the deployed Python files are
+    byte-compiled in the staging directories; the .pyc files of modules
+    that didn't change are kept from the previous deployment.
+    """
+    plugin_dirs = project.plugin_dirs
+    install_dirs = []
+    for plugin_dir in plugin_dirs:
+        if read_manifest(plugin_dir) and not supports_hard_links(plugin_dir):
+            click.secho("{0} doesn't support hard links, so it is updated in "
+                        "place (no rollback)".format(plugin_dir), fg='yellow')
+            install_dirs.append(plugin_dir)
+            continue
+        staging = sibling_dirs(plugin_dir)[0]
+        try:
+            stage_plugin_dir(plugin_dir, staging)
+        except OSError as oops:
+            click.secho("Unable to stage the plugin in {0}: {1}".format(
+                staging, oops.strerror), fg='red')
+            for install_dir in install_dirs:
+                if install_dir not in plugin_dirs:
+                    remove_tree(install_dir)
+            return False
+        install_dirs.append(staging)
+    stagings = [install_dir for install_dir in install_dirs
+                if install_dir not in plugin_dirs]
+    if not install_files(project, jobs=copy_jobs or jobs, link=link,
+                         plugin_dirs=install_dirs, targets=plugin_dirs):
+        for staging in stagings:
+            remove_tree(staging)
+        click.secho("Deployment failed---{0} {1} not changed".format(
+            ', '.join(plugin_dirs),
+            'was' if len(plugin_dirs) == 1 else 'were'), fg='red')
+        return False
+    if bytecode:
+        levels, invalidation = bytecode
+        tasks = []
+        for index, plugin_dir in enumerate(plugin_dirs):
+            install_dir = install_dirs[index]
+            for target in sorted(read_manifest(install_dir)):
+                if target.endswith('.py'):
+                    source = os.path.join(install_dir, target)
+                    for optimize in levels:
+                        tasks.append((source, cache_name(source, optimize),
+                                      os.path.join(plugin_dir, target),
+                                      optimize))
+        # like compileall, a module that doesn't compile is reported but
+        # doesn't stop the deploy; importing it will fail either way
+        for pyc, error in sorted(compile_bytecode(tasks, invalidation,
+                                                  jobs)):
+            click.secho("Error byte-compiling files: {0}".format(error),
+                        fg='red')
+    swapped = True
+    for index, plugin_dir in enumerate(plugin_dirs):
+        if install_dirs[index] == plugin_dir:
+            continue
+        staging, previous = sibling_dirs(plugin_dir)
+        try:
+            if os.path.lexists(previous):
+                remove_tree(previous)
+            if not os.path.lexists(plugin_dir):
+                os.rename(staging, plugin_dir)
+            else:
+                swap_dirs(staging, plugin_dir)
+                os.rename(staging, previous)
+        except OSError as oops:
+            click.secho("Unable to swap in the new version of {0}: "
+                        "{1}".format(plugin_dir, oops.strerror), fg='red')
+            swapped = False
+    return swapped
 
 
-def install_files(plugin_dir, cfg):
+def sibling_dirs(plugin_dir):
+    """
+    Return the staging directory and the directory keeping the previous
+    deployment of plugin_dir. They are hidden so QGIS doesn't mistake them
+    for plugins, and on the same file system so they can be renamed.
+    """
+    parent, name = os.path.split(os.path.normpath(plugin_dir))
+    return (os.path.join(parent, '.{0}.pb_tool-staging'.format(name)),
+            os.path.join(parent, '.{0}.pb_tool-previous'.format(name)))
+
+
+@profiled_stage('stage')
+def stage_plugin_dir(plugin_dir, staging):
+    """
+    Start staging off with hard links to the files the current deployment
+    recorded in its manifest (and the .pyc files of its modules), so only
+    new and changed files have to be written. Anything else in plugin_dir
+    is left behind. Files are always replaced, never written through,
+    which leaves the deployment being served untouched.
+    """
+    if os.path.lexists(staging):
+        # left over from an interrupted deploy
+        remove_tree(staging)
+    os.makedirs(staging)
+    manifest = read_manifest(plugin_dir)
+    if not manifest:
+        return
+    names = [MANIFEST_NAME]
+    for target in manifest:
+        names.append(target)
+        if target.endswith('.py'):
+            directory, module = os.path.split(target)
+            names.extend(
+                os.path.relpath(pyc, plugin_dir) for pyc in glob.glob(
+                    os.path.join(glob.escape(plugin_dir), glob.escape(directory),
+                                 '__pycache__',
+                                 glob.escape(module[:-3]) + '.*.pyc')))
+    for name in names:
+        source = os.path.join(plugin_dir, name)
+        destination = os.path.join(staging, name)
+        if not os.path.lexists(source):
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.islink(source):
+            # a link deploy
+            os.symlink(os.readlink(source), destination)
+        else:
+            link_or_copy(source, destination)
+
+
+def supports_hard_links(directory):
+    """ Whether files can be hard linked in directory """
+    import tempfile
+    fd, path = tempfile.mkstemp(prefix='.pb_tool-', dir=directory)
+    os.close(fd)
+    try:
+        os.link(path, path + '-link')
+        os.unlink(path + '-link')
+        return True
+    except OSError:
+        return False
+    finally:
+        os.unlink(path)
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        copy_file(source, destination)
+
+
+@profiled_stage('swap')
+def swap_dirs(first, second):
+    """
+    Exchange two directories. Linux does this atomically with
+    renameat2(RENAME_EXCHANGE); elsewhere second is missing for the moment
+    between two renames.
+    """
+    if sys.platform.startswith('linux'):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = getattr(libc, 'renameat2', None)
+        if renameat2 is not None:
+            at_fdcwd, rename_exchange = -100, 2
+            renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_uint]
+            if renameat2(at_fdcwd, os.fsencode(first), at_fdcwd,
+                         os.fsencode(second), rename_exchange) == 0:
+                return
+            # not supported by the file system (EINVAL) or kernel (ENOSYS)
+    temp = '{0}.pb_tool-swap'.format(first)
+    os.rename(second, temp)
+    try:
+        os.rename(first, second)
+    except OSError:
+        os.rename(temp, second)
+        raise
+    os.rename(temp, first)
+
+
+@cli.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--plugin_path', '-p',
+              multiple=True,
+              help='Specify the directory where your plugin is deployed if '
+                   'not using the standard location; may be repeated')
+def rollback(config, plugin_path):
+    """ Swap the deployed plugin with the version deployed before it """
+    plugin_dirs = Project(config, plugin_path).plugin_dirs
+    if not plugin_dirs:
+        click.secho("Unable to determine where your plugin is deployed",
+                    fg='red')
+        sys.exit(1)
+    missing = [plugin_dir for plugin_dir in plugin_dirs
+               if not os.path.lexists(sibling_dirs(plugin_dir)[1])]
+    if missing:
+        for plugin_dir in missing:
+            click.secho("There is no previous deployment of {0}".format(
+                plugin_dir), fg='red')
+        sys.exit(1)
+    for plugin_dir in plugin_dirs:
+        previous = sibling_dirs(plugin_dir)[1]
+        if os.path.lexists(plugin_dir):
+            swap_dirs(previous, plugin_dir)
+        else:
+            os.rename(previous, plugin_dir)
+        click.secho("Rolled back {0}; run rollback again to undo".format(
+            plugin_dir), fg='green')
+
+
+@profiled_stage('install')
+def install_files(project, changed=None, jobs=None, link=None,
+                  plugin_dirs=None, targets=None):
+    """Bring plugin_dirs (default: the project's) up to date with the
+    files declared in the config, using up to jobs threads.
+
+    Only new or changed files, or those in changed if given, are copied or
+    linked (link is 'symlink' or 'hardlink'); files the previous manifest
+    lists that are no longer declared are removed, those that failed to
+    install are left as they were. targets name the
+    directories in the summary. Returns False if existing files could not
+    be installed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
     errors = []
-    install_files = get_install_files(cfg)
-    # make the plugin directory if it doesn't exist
-    if not os.path.exists(plugin_dir):
-        os.mkdir(plugin_dir)
-
-    fail = False
-    for file in install_files:
-        click.secho("Copying {0}".format(file), fg='magenta', nl=False)
-        try:
-            shutil.copy(file, os.path.join(plugin_dir, file))
-            print("")
-        except Exception as oops:
-            errors.append(
-                "Error copying files: {0}, {1}".format(file, oops.strerror))
-            click.echo(click.style(' ----> ERROR', fg='red'))
-            fail = True
-        extra_dirs = cfg.get('files', 'extra_dirs').split()
-        #print "EXTRA DIRS: {}".format(extra_dirs)
-    for xdir in extra_dirs:
-        click.secho("Copying contents of {0} to {1}".format(xdir, plugin_dir),
-                    fg='magenta',
-                    nl=False)
-        try:
-            copy_tree(xdir, "{0}/{1}".format(plugin_dir, xdir))
-            print("")
-        except Exception as oops:
-            errors.append(
-                "Error copying directory: {0}, {1}".format(xdir, oops.message))
-            click.echo(click.style(' ----> ERROR', fg='red'))
-            fail = True
-    help_src = cfg.get('help', 'dir')
-    help_target = os.path.join(plugin_dir,
-                               cfg.get('help', 'target'))
-    click.secho("Copying {0} to {1}".format(help_src, help_target),
-                fg='magenta',
-                nl=False)
-    #shutil.copytree(help_src, help_target)
-    try:
-        copy_tree(help_src, help_target)
-        print("")
-    except Exception as oops:
-        errors.append("Error copying help files: {0}, {1}".format(
-            help_src, oops.message))
-        click.echo(click.style(' ----> ERROR', fg='red'))
-        fail = True
-    if fail:
+    failed = False
+    plugin_dirs = plugin_dirs or project.plugin_dirs
+    # make the plugin directories if they don't exist
+    for plugin_dir in plugin_dirs:
+        if not os.path.exists(plugin_dir):
+            os.makedirs(plugin_dir)
+
+    started = time.time()
+    previous = [read_manifest(plugin_dir) for plugin_dir in plugin_dirs]
+    deployed = [{} for plugin_dir in plugin_dirs]
+    copied = [0] * len(plugin_dirs)
+    copied_bytes = [0] * len(plugin_dirs)
+    unchanged = [0] * len(plugin_dirs)
+    with ThreadPoolExecutor(max_workers=jobs or COPY_JOBS) as pool:
+        futures = {}
+        for source, target in get_install_entries(project):
+            entries = [manifest.get(target) for manifest in previous]
+            if changed is not None and source not in changed:
+                for index, entry in enumerate(entries):
+                    if entry:
+                        deployed[index][target] = entry
+                        unchanged[index] += 1
+                continue
+            destinations = [os.path.join(plugin_dir, target)
+                            for plugin_dir in plugin_dirs]
+            future = pool.submit(install_file, source, destinations, entries,
+                                 link)
+            futures[future] = (source, target, entries)
+
+        with click.progressbar(length=len(futures),
+                               label='Linking files' if link
+                               else 'Copying files') as progress:
+            for future in as_completed(futures):
+                source, target, entries = futures[future]
+                try:
+                    results = future.result()
+                    for index, (was_copied, record) in enumerate(results):
+                        deployed[index][target] = record
+                        if was_copied:
+                            copied[index] += 1
+                            copied_bytes[index] += record.get('size', 0)
+                        else:
+                            unchanged[index] += 1
+                except (IOError, OSError) as oops:
+                    errors.append("Error {0} files: {1}, {2}".format(
+                        'linking' if link else 'copying', source,
+                        oops.strerror))
+                    failed = failed or os.path.exists(source)
+                    # keep what the last deploy left rather than removing it
+                    for index, entry in enumerate(entries):
+                        if entry:
+                            deployed[index][target] = entry
+                progress.update(1)
+
+    for index, plugin_dir in enumerate(plugin_dirs):
+        removed = 0
+        for target in sorted(set(previous[index]) - set(deployed[index])):
+            try:
+                os.unlink(os.path.join(plugin_dir, target))
+                remove_empty_dirs(plugin_dir, os.path.dirname(target))
+                removed += 1
+            except OSError:
+                # already gone or never made it---nothing to remove
+                pass
+        write_manifest(plugin_dir, deployed[index])
+        if len(plugin_dirs) > 1:
+            click.secho("{0}:".format((targets or plugin_dirs)[index]),
+                        fg='green')
+        if link:
+            click.secho("Linked {0} files, {1} unchanged, {2} removed".format(
+                copied[index], unchanged[index], removed), fg='green')
+        else:
+            click.secho("Copied {0} files, {1} unchanged, {2} removed "
+                        "({3} in {4:.1f}s)".format(
+                            copied[index], unchanged[index], removed,
+                            format_size(copied_bytes[index]),
+                            time.time() - started),
+                        fg='green')
+
+    if errors:
         print("\nERRORS:")
-        for error in errors:
+        for error in sorted(errors):
             print(error)
         print("")
         print(
@@ -221,46 +1185,572 @@ def install_files(plugin_dir, cfg):
             "them from the config. To ensure proper deployment, make sure your\n"
             "UI and resource files are compiled. Using dclean to delete the\n"
             "plugin before deploying may also help.")
+    return not failed
+
+
+def install_file(source, destinations, entries, link=None):
+    """
+    Copy or link source to each of destinations, entries being their
+    records in the manifests (see sync_file and sync_link). The source is
+    hashed at most once. Returns whether it was installed and the new
+    record, for each destination.
+    """
+    with profiled(source, 'link' if link else 'copy') as record:
+        if link:
+            return [sync_link(source, destination, entries[index], link)
+                    for index, destination in enumerate(destinations)]
+        digest = functools.lru_cache(maxsize=1)(
+            functools.partial(file_hash, source))
+        results = []
+        for index, destination in enumerate(destinations):
+            installed, manifest_record = sync_file(source, destination,
+                                                   entries[index], digest)
+            if installed:
+                record['bytes'] = record.get('bytes', 0) + \
+                    manifest_record['size']
+            results.append((installed, manifest_record))
+        return results
+
+
+def sync_file(source, destination, entry, digest=None):
+    """
+    Copy source to destination unless entry, its record in the manifest of
+    the last deploy, shows it is unchanged. digest, if given, returns the
+    hash of source. Returns whether it was copied and the new manifest
+    record.
+    """
+    if entry and 'link' in entry:
+        # a link deploy is being replaced with copies
+        entry = None
+    st = os.stat(source)
+    if entry and entry['size'] == st.st_size \
+            and entry['mtime'] == st.st_mtime_ns \
+            and os.path.exists(destination):
+        return False, entry
+    record = {'size': st.st_size,
+              'mtime': st.st_mtime_ns,
+              'sha256': digest() if digest else file_hash(source)}
+    if entry and entry['sha256'] == record['sha256'] \
+            and os.path.exists(destination):
+        return False, record
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    replace_file(source, destination)
+    return True, record
+
+
+def sync_link(source, destination, entry, link):
+    """
+    Make destination a link to source, link being 'symlink' or 'hardlink'.
+    A hard link falls back to a symbolic link if source is on another file
+    system. Returns whether a link was made and the new manifest record.
+    """
+    source = os.path.abspath(source)
+    # don't leave a dangling link for a file that doesn't exist
+    os.stat(source)
+    record = {'link': link, 'source': source}
+    if entry == record and links_to(destination, source):
+        return False, entry
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temp = '{0}.pb_tool-tmp'.format(destination)
+    try:
+        if link == 'hardlink':
+            try:
+                os.link(source, temp)
+            except OSError as oops:
+                if oops.errno != errno.EXDEV:
+                    raise
+                os.symlink(source, temp)
+        else:
+            os.symlink(source, temp)
+        # replaces a previously copied file or link without touching
+        # what it pointed to
+        os.replace(temp, destination)
+    except (IOError, OSError):
+        if os.path.lexists(temp):
+            os.unlink(temp)
+        raise
+    return True, record
+
+
+def links_to(destination, source):
+    """ Return True if destination is a symbolic or hard link to source """
+    try:
+        if os.path.islink(destination):
+            return os.readlink(destination) == source
+        return os.path.samefile(destination, source)
+    except OSError:
+        return False
+
+
+def get_install_entries(project):
+    """
+    Resolve everything that is deployed with the plugin into
+    (source, target) pairs, target being relative to the plugin directory.
+    The contents of extra_dirs and the help directory are expanded to
+    individual files, leaving out what the project's exclude patterns
+    exclude.
+    """
+    entries = [(project.path(file), file) for file in project.install_files]
+    dirs = [(project.path(xdir), xdir) for xdir in project.extra_dirs]
+    if project.help_dir:
+        dirs.append((project.path(project.help_dir),
+                     project.help_target or 'help'))
+    excludes = project.excludes
+    for src_dir, target_dir in dirs:
+        if not os.path.isdir(src_dir):
+            # keep it so the missing directory is reported when deploying
+            entries.append((src_dir, target_dir))
+            continue
+        # symlinked directories are deployed with their contents, except
+        # links back up the tree
+        for root, subdirs, files in os.walk(src_dir, followlinks=True):
+            rel_root = os.path.relpath(root, src_dir)
+            real_root = os.path.realpath(root)
+            subdirs[:] = [subdir for subdir in subdirs
+                          if not is_link_cycle(os.path.join(root, subdir),
+                                               real_root)]
+            if excludes:
+                # the path of the directory in the project, for matching
+                path = os.path.normpath(os.path.relpath(
+                    root, project.root or os.curdir)).replace(os.sep, '/')
+                # excluded directories are not walked at all
+                subdirs[:] = [subdir for subdir in subdirs
+                              if not excludes.excluded(
+                                  '{0}/{1}'.format(path, subdir), True)]
+                files = [name for name in files if not excludes.excluded(
+                    '{0}/{1}'.format(path, name))]
+            subdirs.sort()
+            for name in sorted(files):
+                target = os.path.normpath(
+                    os.path.join(target_dir, rel_root, name))
+                entries.append((os.path.join(root, name), target))
+    # compiled translations are often in an extra_dirs directory as well
+    seen = set()
+    unique = []
+    for source, target in entries:
+        if target not in seen:
+            seen.add(target)
+            unique.append((source, target))
+    return unique
+
+
+def is_link_cycle(path, real_root):
+    """ Whether path is a symlink to real_root or a directory above it """
+    if not os.path.islink(path):
+        return False
+    real = os.path.realpath(path)
+    return real == real_root or real_root.startswith(
+        real.rstrip(os.sep) + os.sep)
+
+
+def read_manifest(plugin_dir):
+    """ Return the files recorded by the last deploy to plugin_dir """
+    try:
+        with open(os.path.join(plugin_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest['files']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def write_manifest(plugin_dir, files):
+    # replaced rather than rewritten, it may be hard linked from the
+    # deployment being served
+    manifest = os.path.join(plugin_dir, MANIFEST_NAME)
+    temp = '{0}.pb_tool-tmp'.format(manifest)
+    with open(temp, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f,
+                  indent=1, sort_keys=True)
+    os.replace(temp, manifest)
+
+
+def file_hash(path):
+    """ Return the sha256 hex digest of the contents of path """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def replace_file(source, destination):
+    """
+    Copy source over destination without writing through the existing
+    file, so a reader never sees a partially written file. The temporary
+    file is named after the process and thread: builds sharing a cache
+    directory may write the same entry at once.
+    """
+    temp = '{0}.{1}-{2}.pb_tool-tmp'.format(destination, os.getpid(),
+                                            threading.get_ident())
+    try:
+        copy_file(source, temp)
+        os.replace(temp, destination)
+    except (IOError, OSError):
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+
+def copy_file(source, destination):
+    """
+    Copy the contents and permission bits of source to destination,
+    letting the kernel move the data where the file system supports it:
+    copy_file_range can clone the file or copy it on the server (NFS 4.2),
+    sendfile at least avoids a round trip through user space.
+    """
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if not kernel_copy(fsrc.fileno(), fdst.fileno(), size):
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copymode(source, destination)
+
+
+def kernel_copy(infd, outfd, size):
+    """
+    Copy size bytes from infd to outfd with copy_file_range or sendfile.
+    Returns False if neither is available for this pair of files, in which
+    case nothing was written.
+    """
+    if size == 0:
+        return True
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(infd, outfd, size - offset,
+                                              offset, offset)
+                else:
+                    sent = os.sendfile(outfd, infd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            # not supported between these file systems (EXDEV, ENOSYS,
+            # EINVAL...); a failure part way through is a real error
+            if offset:
+                raise
+            continue
+        if offset == size:
+            return True
+        if offset:
+            raise OSError(errno.EIO, 'The file changed while it was copied')
+        # nothing copied at all (some file systems just return 0)
+    return False
+
+
+def remove_empty_dirs(plugin_dir, rel_dir):
+    """ Remove rel_dir and its parents if empty, stopping at plugin_dir """
+    while rel_dir:
+        try:
+            os.rmdir(os.path.join(plugin_dir, rel_dir))
+        except OSError:
+            return
+        rel_dir = os.path.dirname(rel_dir)
+
+
+@cli.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--plugin_path', '-p',
+              multiple=True,
+              help='Specify the directory where to deploy your plugin if not '
+                   'using the standard location; may be repeated')
+@click.option('--poll',
+              is_flag=True,
+              help='Poll for changes instead of using inotify (Linux)')
+@click.option('--interval',
+              type=float,
+              default=0.5,
+              help='Seconds between checks when polling')
+def watch(config, plugin_path, poll, interval):
+    """ Compile and deploy changed files as you save them """
+    project = Project(config, plugin_path)
+    if not project.plugin_dirs:
+        click.secho("Unable to determine where to deploy your plugin", fg='red')
+        return
+
+    for plugin_dir in project.plugin_dirs:
+        click.secho("Deploying to {}".format(plugin_dir), fg='green')
+    compile_files(project)
+    install_files(project)
 
+    files, trees = watched_paths(project)
+    watcher = None
+    if not poll:
+        try:
+            watcher = InotifyWatcher(files, trees)
+        except OSError:
+            click.secho("inotify is not available, polling for changes",
+                        fg='yellow')
+    if watcher is None:
+        watcher = PollingWatcher(files, trees, interval)
+
+    click.secho("Watching for changes, press Ctrl+C to stop", fg='green')
+    try:
+        while True:
+            changed = watcher.wait()
+            # editors often save in bursts (backup, write, rename); collect
+            # everything that changes until things settle down
+            while True:
+                more = watcher.wait(WATCH_DEBOUNCE)
+                if not more:
+                    break
+                changed |= more
+            if os.path.normpath(config) in changed:
+                click.secho("{0} changed---restart watch to use the new "
+                            "settings".format(config), fg='yellow')
+            outputs = set(output for source, output
+                          in outdated_sources(project, changed))
+            if outputs:
+                compile_files(project, only=changed)
+            install_files(project, changed | outputs)
+            files, trees = watched_paths(project)
+            watcher.update(files, trees)
+    except KeyboardInterrupt:
+        click.secho("Stopped watching", fg='green')
+    finally:
+        watcher.close()
+
+
+def outdated_sources(project, changed):
+    """
+    Return (source, output) for the ui, resource and translation files
+    affected by the changed paths
+    """
+    dependencies = qrc_dependencies(project.resource_files)
+    affected = [ui for ui in project.compiled_ui_files if ui in changed]
+    affected += [res for res in project.resource_files
+                 if res in changed
+                 or changed.intersection(dependencies.get(res, ()))]
+    outdated = [(source, '{0}.py'.format(os.path.splitext(source)[0]))
+                for source in affected]
+    outdated += [(ts, '{0}.qm'.format(os.path.splitext(ts)[0]))
+                 for ts in project.translation_files if ts in changed]
+    return outdated
+
+
+def watched_paths(project):
+    """
+    Return the files watch looks at and the directories whose whole
+    contents are deployed (extra_dirs and the help directory)
+    """
+    files = set([project.config] + project.compiled_ui_files +
+                project.resource_files + project.translation_files +
+                project.install_files)
+    for dependencies in qrc_dependencies(project.resource_files).values():
+        files.update(dependencies)
+    trees = project.extra_dirs + [project.help_dir or '']
+    trees = [tree for tree in trees if tree]
+    return (set(os.path.normpath(path) for path in files),
+            set(os.path.normpath(path) for path in trees))
+
+
+def in_tree(path, trees):
+    return any(path == tree or path.startswith(tree + os.sep)
+               for tree in trees)
+
+
+class PollingWatcher(object):
+    """ Detect changes by comparing modification times every interval """
+
+    def __init__(self, files, trees, interval):
+        self.interval = interval
+        self.update(files, trees)
+
+    def update(self, files, trees):
+        self.files = files
+        self.trees = trees
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+        paths = set(self.files)
+        for tree in self.trees:
+            for root, subdirs, names in os.walk(tree):
+                paths.update(os.path.join(root, name) for name in names)
+        for path in paths:
+            try:
+                st = os.stat(path)
+                state[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        return state
+
+    def wait(self, timeout=None):
+        """
+        Return the paths that changed, waiting up to timeout seconds (or
+        until something changes if timeout is None)
+        """
+        waited = 0.0
+        while True:
+            delay = self.interval if timeout is None \
+                else min(self.interval, timeout)
+            time.sleep(delay)
+            waited += delay
+            state = self.snapshot()
+            changed = set(path for path in set(state) | set(self.state)
+                          if state.get(path) != self.state.get(path))
+            self.state = state
+            if changed or (timeout is not None and waited >= timeout):
+                return changed
+
+    def close(self):
+        pass
 
-def clean_deployment(ask_first=True, config='pb_tool.cfg'):
+
+class InotifyWatcher(object):
+    """ Detect changes with inotify by watching the directories involved """
+
+    # from <sys/inotify.h>
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+
+    def __init__(self, files, trees):
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        self.update(files, trees)
+
+    def add_watch(self, directory):
+        if directory in self.dirs.values():
+            return
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory or '.'), self.MASK)
+        if wd >= 0:
+            self.dirs[wd] = directory
+
+    def update(self, files, trees):
+        self.files = files
+        self.trees = trees
+        for path in files:
+            self.add_watch(os.path.dirname(path))
+        for tree in trees:
+            for root, subdirs, names in os.walk(tree):
+                self.add_watch(root)
+
+    def wait(self, timeout=None):
+        """
+        Return the paths that changed, waiting up to timeout seconds (or
+        until something changes if timeout is None)
+        """
+        import select
+
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return set()
+            changed = set()
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data,
+                                                              offset)
+                name = os.fsdecode(data[offset + 16:offset + 16 + length]
+                                   .rstrip(b'\0'))
+                offset += 16 + length
+                if wd not in self.dirs:
+                    continue
+                path = os.path.normpath(os.path.join(self.dirs[wd], name))
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO) \
+                            and in_tree(path, self.trees):
+                        self.add_watch(path)
+                elif path in self.files or in_tree(path, self.trees):
+                    changed.add(path)
+            if changed or timeout is not None:
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def clean_deployment(project, ask_first=True):
     """ Remove the deployed plugin from the .qgis2/python/plugins directory
     """
-    name = get_config(config).get('plugin', 'name')
-    plugin_dir = os.path.join(get_plugin_directory(), name)
+    plugin_dirs = project.plugin_dirs
+    if not plugin_dirs:
+        click.secho("Unable to determine where your plugin is deployed",
+                    fg='red')
+        return False
     if ask_first:
         proceed = click.confirm(
-            'Delete the deployed plugin from {0}?'.format(plugin_dir))
+            'Delete the deployed plugin from {0}?'.format(
+                ', '.join(plugin_dirs)))
     else:
         proceed = True
 
     if proceed:
-        click.echo('Removing plugin from {0}'.format(plugin_dir))
-        try:
-            shutil.rmtree(plugin_dir)
-            return True
-        except OSError as oops:
-            print('Plugin was not deleted: {0}'.format(oops.strerror))
+        removed = True
+        for plugin_dir in plugin_dirs:
+            click.echo('Removing plugin from {0}'.format(plugin_dir))
+            try:
+                for path in sibling_dirs(plugin_dir):
+                    if os.path.lexists(path):
+                        remove_tree(path)
+                remove_tree(plugin_dir)
+            except OSError as oops:
+                print('Plugin was not deleted: {0}'.format(oops.strerror))
+                removed = False
+        return removed
     else:
         click.echo('Plugin was not deleted')
     return False
 
 
+def remove_tree(path):
+    """
+    Remove path and everything below it. Links, including path itself and
+    the ones made by deploy --link, are removed and never followed, so the
+    source tree they point into is left alone.
+    """
+    if os.path.islink(path):
+        os.unlink(path)
+    else:
+        # rmtree unlinks symbolic links and junctions it finds instead of
+        # descending into them
+        shutil.rmtree(path)
+
+
 @cli.command()
 def clean_docs():
     """
     Remove the built HTML help files from the build directory
     """
+    import subprocess
     if os.path.exists('help'):
         click.echo('Removing built HTML from the help documentation')
         if sys.platform == 'win32':
             makeprg = 'make.bat'
         else:
             makeprg = 'make'
-        cwd = os.getcwd()
-        os.chdir('help')
-        subprocess.check_call([makeprg, 'clean'])
-        os.chdir(cwd)
+        subprocess.check_call([makeprg, 'clean'], cwd='help')
+        try:
+            os.unlink(DOCS_STATE)
+        except OSError:
+            pass
     else:
         print("No help directory exists in the current directory")
 
@@ -272,7 +1762,7 @@ def clean_docs():
 def dclean(config):
     """ Remove the deployed plugin from the .qgis2/python/plugins directory
     """
-    clean_deployment(True, config)
+    clean_deployment(Project(config), True)
 
 
 @cli.command()
@@ -282,8 +1772,8 @@ def dclean(config):
 def clean(config):
     """ Remove compiled resource and ui files
     """
-    cfg = get_config(config)
-    files = compiled_ui(cfg) + compiled_resource(cfg)
+    project = Project(config)
+    files = project.compiled_ui + project.compiled_resource
     click.echo('Cleaning resource and ui files')
     for file in files:
         try:
@@ -297,69 +1787,154 @@ def clean(config):
 @click.option('--config',
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def compile(config):
+@click.option('--jobs', '-j',
+              type=click.IntRange(min=1),
+              default=None,
+              help='Number of files to compile in parallel (default: number of CPUs)')
+def compile(config, jobs):
     """
-    Compile the resource and ui files
+    Compile the resource, ui and translation files
     """
-    compile_files(get_config(config))
+    workspace = current_workspace()
+    if workspace:
+        workspace.run('compile', jobs,
+                      lambda project, jobs: not compile_files(project, jobs))
+    elif compile_files(Project(config), jobs):
+        sys.exit(1)
 
 
 @cli.command()
-def doc():
+@click.option('--jobs', '-j',
+              type=click.IntRange(min=1),
+              default=None,
+              help='Number of processes Sphinx reads the sources with (default: number of CPUs)')
+@click.option('--force', '-f',
+              is_flag=True,
+              help='Build the docs even if the sources have not changed')
+def doc(jobs, force):
     """ Build HTML version of the help files using sphinx"""
-    build_docs()
+    build_docs(jobs, force)
 
 
-def build_docs():
-    """ Build the docs using sphinx"""
-    if os.path.exists('help'):
-        click.echo('Building the help documentation')
-        if sys.platform == 'win32':
-            makeprg = 'make.bat'
+@profiled_stage('docs')
+def build_docs(jobs=None, force=False, root=''):
+    """
+    Build the docs using sphinx, unless nothing in the help directory
+    outside help/build changed since the last successful build. Sphinx is
+    run in-process when it can be imported, reading the sources in jobs
+    processes; otherwise make html is run in the help directory. The help
+    directory is looked for in root, the current directory by default.
+    Returns False if the build failed.
+    """
+    help_dir = os.path.join(root, 'help')
+    if not os.path.exists(help_dir):
+        print("No help directory exists in {0}".format(
+            root or 'the current directory'))
+        return True
+    source = os.path.join(root, DOCS_SOURCE)
+    output = os.path.join(root, DOCS_OUTPUT)
+    state = os.path.join(root, DOCS_STATE)
+    fingerprint = docs_fingerprint(help_dir)
+    try:
+        with open(state) as f:
+            built = json.load(f).get('fingerprint')
+    except (IOError, OSError, ValueError, AttributeError):
+        built = None
+    # without help/source or help/conf.py there's no telling what make
+    # html reads, so it is always run
+    known = os.path.isdir(source) or os.path.exists(
+        os.path.join(help_dir, 'conf.py'))
+    if not force and known and fingerprint == built and \
+            os.path.isdir(output):
+        click.echo('Skipping the help documentation (unchanged)')
+        return True
+
+    click.echo('Building the help documentation')
+    try:
+        from sphinx.cmd.build import build_main
+    except ImportError:
+        build_main = None
+    if build_main is not None and \
+            os.path.exists(os.path.join(source, 'conf.py')):
+        arguments = ['-b', 'html',
+                     '-d', os.path.join(help_dir, 'build', 'doctrees'),
+                     '-j', str(jobs or os.cpu_count()), source, output]
+        if threading.current_thread() is threading.main_thread():
+            status = build_main(arguments)
         else:
-            makeprg = 'make'
-        cwd = os.getcwd()
-        os.chdir('help')
-        subprocess.check_call([makeprg, 'html'])
-        os.chdir(cwd)
+            # Sphinx keeps global state and changes the current directory
+            # while reading conf.py, under the feet of the other plugins
+            # being built, so concurrent builds each get a process
+            import subprocess
+            result = subprocess.run(
+                [sys.executable, '-m', 'sphinx'] + arguments,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True)
+            click.echo(result.stdout, nl=False)
+            status = result.returncode
     else:
-        print("No help directory exists in the current directory")
+        import subprocess
+        makeprg = 'make.bat' if sys.platform == 'win32' else 'make'
+        try:
+            status = subprocess.call([makeprg, 'html'], cwd=help_dir)
+        except OSError as oops:
+            click.secho("Unable to run {0}: {1}".format(
+                makeprg, oops.strerror), fg='red')
+            status = 1
+    if status:
+        click.secho("Building the help documentation failed", fg='red')
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(state), exist_ok=True)
+        with open(state, 'w') as f:
+            json.dump({'fingerprint': fingerprint}, f)
+    except (IOError, OSError):
+        pass
+    return True
+
+
+def docs_fingerprint(source_dir):
+    """
+    Fingerprint of the names, sizes and modification times of the files
+    below source_dir, leaving out what Sphinx builds in build or _build
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(source_dir):
+        if root == source_dir:
+            dirs[:] = [name for name in dirs if name not in ('build', '_build')]
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            digest.update('{0}\0{1}\0{2}\n'.format(
+                os.path.relpath(path, source_dir), st.st_size,
+                st.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
 
 
 @cli.command()
 @click.option('--config',
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def translate(config):
-    """ Build translations using lrelease. Locales must be specified
+@click.option('--jobs', '-j',
+              type=click.IntRange(min=1),
+              default=None,
+              help='Number of translations to compile in parallel (default: number of CPUs)')
+def translate(config, jobs):
+    """ Build the translations. Locales must be specified
     in the config file and the corresponding .ts file must exist in
-    the i18n directory of your plugin."""
-    possibles = ['lrelease', 'lrelease-qt4']
-    for binary in possibles:
-        cmd = check_path(binary)
-        if cmd:
-            break
-    if not cmd:
-        print("Unable to find the lrelease command. Make sure it is installed"
-              "  and in your path.")
-        if sys.platform == 'win32':
-            print('You can get lrelease by installing'
-                  ' the qt4-devel package in the Libs'
-                  '\nsection of the OSGeo4W Advanced Install.')
-    else:
-        cfg = get_config(config)
-        if check_cfg(cfg, 'files', 'locales'):
-            locales = cfg.get('files', 'locales').split()
-            if locales:
-                for locale in locales:
-                    (name, ext) = os.path.splitext(locale)
-                    if ext != '.ts':
-                        print('no ts extension')
-                        locale = name + '.ts'
-                    print(cmd, locale)
-                    subprocess.check_call([cmd, os.path.join('i18n', locale)])
-            else:
-                print("No translations are specified in {0}".format(config))
+    the i18n directory of your plugin. Only translations whose .ts file
+    changed since the .qm was built are compiled."""
+    project = Project(config)
+    if not project.translation_files:
+        print("No translations are specified in {0}".format(config))
+    elif compile_translation_files(project, project.translation_files,
+                                   BuildCache.from_config(project.cfg), jobs):
+        sys.exit(1)
 
 
 @cli.command()
@@ -369,73 +1944,525 @@ def translate(config):
 @click.option(
     '--quick', '-q',
     is_flag=True,
-    help='Do a quick packaging without dclean and deploy (plugin must have been previously deployed)'
+    help='Package the files as they are without compiling ui, resource and help files first'
 )
-def zip(config, quick):
+@click.option('--level', '-l',
+              type=click.IntRange(0, 9),
+              default=6,
+              help='Compression level from 0 (no compression) to 9 (smallest archive)')
+@click.option('--jobs', '-j',
+              type=click.IntRange(min=1),
+              default=None,
+              help='Number of files to compile and compress in parallel (default: number of CPUs)')
+@click.option('--reproducible', '-r',
+              is_flag=True,
+              help='Build a byte-identical archive from identical inputs: sorted entries, '
+                   'fixed timestamps and normalized permissions')
+@click.option('--force', '-f',
+              is_flag=True,
+              help='Rebuild the archive even if its inputs are unchanged')
+@click.option('--bytecode', '-b',
+              is_flag=True,
+              help='Byte-compile the Python files so the plugin starts '
+                   'without compiling anything (see [bytecode] in the '
+                   'config for the optimization levels and how the .pyc '
+                   'files are checked)')
+def zip(config, quick, level, jobs, reproducible, force, bytecode):
     """ Package the plugin into a zip file
     suitable for uploading to the QGIS
     plugin repository"""
+    workspace = current_workspace()
+    if workspace:
+        workspace.run('zip', jobs, lambda project, jobs: zip_plugin(
+            project, quick, level, jobs, reproducible, force, bytecode))
+        return
+    if not zip_plugin(Project(config), quick, level, jobs, reproducible,
+                      force, bytecode):
+        sys.exit(1)
+
+
+def zip_plugin(project, quick=False, level=6, jobs=None, reproducible=False,
+               force=False, bytecode=False):
+    """
+    Compile and package the plugin into <name>.zip in the project
+    directory, with byte-compiled modules if bytecode is set or configured.
+    Returns False if it could not be packaged or files are missing from it.
+    """
+    name = project.name
+    if not name:
+        click.echo(
+            "Your config file is missing the plugin name (name=parameter)")
+        return False
+    if not quick:
+        if compile_files(project, jobs):
+            click.secho("Compilation failed---the plugin was not packaged",
+                        fg='red')
+            return False
+        if not build_docs(jobs, root=project.root):
+            click.secho("The plugin was not packaged", fg='red')
+            return False
+    if reproducible or project.cfg.getboolean('zip', 'reproducible',
+                                              fallback=False):
+        epoch = source_date_epoch(project)
+    else:
+        epoch = None
+    written = package_plugin(project, project.path('{0}.zip'.format(name)),
+                             level, jobs, epoch, force,
+                             bytecode_options(project.cfg, bytecode))
+    if written is None:
+        click.secho('{0}.zip is up to date (inputs unchanged)'.format(name),
+                    fg='green')
+        return True
+    print('The {0}.zip archive has been created in {1}'.format(
+        name, project.root or 'the current directory'))
+    return written
+
+
+@profiled_stage('package')
+def package_plugin(project, zip_name, level=6, jobs=None, epoch=None,
+                   force=False, bytecode=None):
+    """
+    Write the files that would be deployed straight from the source tree
+    into zip_name, under a directory named after the plugin. Nothing is
+    written to the plugin directory.
+
+    Members are compressed concurrently by up to jobs threads (zlib releases
+    the GIL) and written to the archive in the order of the install set.
+    Files that are already compressed are stored as they are.
+
+    If epoch is given the archive is reproducible: entries are sorted and
+    get epoch as their timestamp and normalized permissions.
+
+    With bytecode (see bytecode_options) the Python modules are
+    byte-compiled into the archive as well. The .pyc files are always
+    hash-based: the files extracted from the archive get new timestamps.
+
+    A fingerprint of the inputs and options is kept in the archive comment.
+    Unless force is set, nothing is done if zip_name already has the same
+    fingerprint. Returns None if it was up to date, otherwise whether the
+    archive is complete; an incomplete one gets no fingerprint so it is
+    rebuilt next time.
+    """
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = jobs or os.cpu_count()
+    members = [(source, '/'.join([project.name] + target.split(os.sep)))
+               for source, target in get_install_entries(project)]
+    if bytecode and bytecode[1] == 'timestamp':
+        bytecode = (bytecode[0], 'checked-hash')
+    if epoch is not None:
+        members.sort(key=lambda member: member[1])
+
+    comment = 'pb_tool:{0}'.format(
+        package_fingerprint(members, level, epoch, jobs,
+                            bytecode)).encode('ascii')
+    if not force:
+        try:
+            with zipfile.ZipFile(zip_name) as existing:
+                if existing.comment == comment:
+                    return None
+        except (IOError, OSError, zipfile.BadZipFile):
+            pass
+
+    errors = []
+
+    def write_next(pending):
+        source, future = pending.popleft()
+        try:
+            zinfo, data = future.result()
+            archive.write(zinfo, source if data is None else data)
+        except (IOError, OSError) as oops:
+            errors.append("Error packaging files: {0}, {1}".format(
+                source, oops.strerror))
+
+    temp = '{0}.pb_tool-tmp'.format(zip_name)
+    build = None
+    try:
+        if bytecode:
+            import tempfile
+            build = tempfile.mkdtemp(prefix='pb_tool-')
+            members += bytecode_members(members, build, bytecode, jobs,
+                                        errors)
+            if epoch is not None:
+                members.sort(key=lambda member: member[1])
+        with ZipWriter(temp) as archive, \
+                ThreadPoolExecutor(max_workers=jobs) as pool:
+            # only keep a few members in flight so memory use stays bounded
+            pending = collections.deque()
+            for source, arcname in members:
+                pending.append((source, pool.submit(compress_member, source,
+                                                    arcname, level, epoch)))
+                if len(pending) >= 2 * jobs:
+                    write_next(pending)
+            while pending:
+                write_next(pending)
+            if not errors:
+                archive.comment = comment
+        os.replace(temp, zip_name)
+    finally:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        if build:
+            shutil.rmtree(build, ignore_errors=True)
+    if errors:
+        print("\nERRORS:")
+        for error in errors:
+            print(error)
+        print("")
+        print("One or more files/directories specified in your config file\n"
+              "are missing from the package---make sure they exist or if not\n"
+              "needed remove them from the config.")
+    return not errors
+
+
+@profiled_stage('fingerprint')
+def package_fingerprint(members, level, epoch, jobs=None, bytecode=None):
+    """
+    Hash the names and contents of the archive members together with the
+    options that affect the archive
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    def member_digest(member):
+        try:
+            return member[1], file_hash(member[0])
+        except (IOError, OSError):
+            return member[1], None
+
+    digest = hashlib.sha256()
+    if bytecode:
+        # the .pyc files only fit the Python version they were made by
+        bytecode = [bytecode, sys.implementation.cache_tag]
+    digest.update(json.dumps([__version()[0], level, epoch,
+                              bytecode]).encode('utf-8'))
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for arcname, content in pool.map(member_digest, members):
+            digest.update(json.dumps([arcname, content]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def bytecode_members(members, directory, bytecode, jobs=None, errors=None):
+    """
+    Byte-compile the Python modules among the archive members into
+    directory and return them as (pyc, arcname) members. Modules that
+    fail to compile are added to errors.
+    """
+    levels, invalidation = bytecode
+    tasks = []
+    pycs = []
+    for source, arcname in members:
+        if not arcname.endswith('.py'):
+            continue
+        for optimize in levels:
+            cache = cache_name(arcname, optimize).replace(os.sep, '/')
+            cfile = os.path.join(directory, *cache.split('/'))
+            tasks.append((source, cfile, arcname, optimize))
+            pycs.append((cfile, cache))
+    failures = compile_bytecode(tasks, invalidation, jobs)
+    if errors is not None:
+        errors.extend("Error byte-compiling files: {0}".format(error)
+                      for cfile, error in failures)
+    failed = set(cfile for cfile, error in failures)
+    return [pyc for pyc in pycs if pyc[0] not in failed]
+
+
+def bytecode_options(cfg, enabled=False):
+    """
+    Return the optimization levels and the invalidation mode (timestamp,
+    checked-hash or unchecked-hash) from the [bytecode] section of cfg, or
+    None unless byte-compiling is enabled there or by enabled
+    """
+    if not (enabled or cfg.getboolean('bytecode', 'enabled',
+                                      fallback=False)):
+        return None
+    try:
+        levels = sorted(set(int(level) for level in cfg.get(
+            'bytecode', 'optimize', fallback='0').split()))
+    except ValueError:
+        levels = None
+    if not levels or not set(levels) <= set((0, 1, 2)):
+        raise click.UsageError('optimize in [bytecode] must list levels 0, 1 '
+                               'or 2')
+    invalidation = cfg.get('bytecode', 'invalidation',
+                           fallback='checked-hash')
+    if invalidation not in PYC_INVALIDATION:
+        raise click.UsageError('invalidation in [bytecode] must be one of '
+                               '{0}'.format(', '.join(PYC_INVALIDATION)))
+    return levels, invalidation
+
+
+def cache_name(source, optimize=0):
+    """ The name of the .pyc file of source at an optimization level """
+    import importlib.util
+    return importlib.util.cache_from_source(
+        source, optimization=optimize or '')
+
+
+@profiled_stage('bytecode')
+def compile_bytecode(tasks, invalidation='checked-hash', jobs=None):
+    """
+    Byte-compile the (source, pyc, display name, optimization level) tasks
+    whose .pyc is missing or out of date, like compileall but in up to
+    jobs processes (default: the number of CPUs). invalidation is how the
+    .pyc files are checked against their sources when imported. Returns
+    (pyc, error message) for the files that failed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    outdated = [task + (invalidation,) for task in tasks
+                if not pyc_current(task[0], task[1], invalidation)]
+    if len(outdated) < 2 or jobs == 1:
+        errors = [compile_pyc(task) for task in outdated]
+    else:
+        workers = min(jobs or os.cpu_count(), len(outdated))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=process_context()) as pool:
+            errors = pool.map(compile_pyc, outdated,
+                              chunksize=max(1, len(outdated) // (4 * workers)))
+    failures = [(outdated[index][1], error)
+                for index, error in enumerate(errors) if error]
+    click.echo("Byte-compiled {0} files, {1} unchanged".format(
+        len(outdated) - len(failures), len(tasks) - len(outdated)))
+    return failures
+
+
+def compile_pyc(task):
+    """ Run a compile_bytecode task, returning an error message or None """
+    import py_compile
+    source, cfile, dfile, optimize, invalidation = task
+    mode = py_compile.PycInvalidationMode[invalidation.upper().replace(
+        '-', '_')]
+    try:
+        py_compile.compile(source, cfile, dfile, doraise=True,
+                           optimize=optimize, invalidation_mode=mode)
+    except py_compile.PyCompileError as oops:
+        return oops.msg.strip()
+    except (IOError, OSError) as oops:
+        return '{0}, {1}'.format(source, oops.strerror)
+    return None
 
-    # check to see if we can find zip or 7z
-    use_7z = False
-    zip = check_path('zip')
-    if not zip:
-        # check for 7z
-        zip = check_path('7z')
-        if not zip:
-            click.secho('zip or 7z not found. Unable to package the plugin',
-                        fg='red')
-            click.secho('Check your path or install a zip program', fg='red')
-            return
-        else:
-            use_7z = True
-    click.secho('Found zip: %s' % zip, fg='green')
 
-    name = get_config(config).get('plugin', 'name', fallback=None)
-    if not quick:
-        proceed = click.confirm('This requires a dclean and deploy first. Proceed?')
-        if proceed:
-            #clean_deployment(False, config)
-            deploy_files(config, plugin_path=None, confirm=False)
-    else:
-        # Check to see if the plugin directory exists, otherwise we can't
-        # do a quick zip
-        if not os.path.exists(os.path.join(get_plugin_directory(), name)):
-            # click.secho(
-            #     "You must deploy the plugin before you can package it using -q",
-            #     fg='red')
-            # proceed = click.confirm(
-            #     'Do you want to deploy and proceed with packaging?')
-            # if proceed:
-            deploy_files(config, plugin_path=None, confirm=False)
-        proceed = True
+def pyc_current(source, cfile, invalidation):
+    """
+    Return True if cfile is a .pyc of the running Python for source as it
+    is now, checked the way invalidation says
+    """
+    import importlib.util
+    try:
+        with open(cfile, 'rb') as f:
+            header = f.read(16)
+        if len(header) < 16 or header[:4] != importlib.util.MAGIC_NUMBER:
+            return False
+        flags = struct.unpack('<I', header[4:8])[0]
+        if invalidation == 'timestamp':
+            st = os.stat(source)
+            return flags == 0 and header[8:16] == struct.pack(
+                '<II', int(st.st_mtime) & 0xFFFFFFFF, st.st_size & 0xFFFFFFFF)
+        with open(source, 'rb') as f:
+            source_hash = importlib.util.source_hash(f.read())
+        checked = invalidation == 'checked-hash'
+        return flags == (0b11 if checked else 0b01) and \
+            header[8:16] == source_hash
+    except (IOError, OSError):
+        return False
+
+
+def source_date_epoch(project):
+    """
+    The timestamp used for the entries of a reproducible package: [zip]
+    epoch from the config, the SOURCE_DATE_EPOCH environment variable or
+    the time of the last git commit, in that order
+    """
+    import subprocess
+    epoch = project.cfg.get('zip', 'epoch', fallback=None) or \
+        os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return int(epoch)
+    try:
+        result = subprocess.run(['git', 'log', '-1', '--format=%ct'],
+                                cwd=project.root or None,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True, check=True)
+        return int(result.stdout.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        # the earliest time a zip file can record
+        return 315532800
+
+
+def compress_member(source, arcname, level, epoch=None):
+    """
+    Prepare the archive member for source. Returns its ZipInfo and a
+    temporary file holding the deflated data, or None as the data when the
+    member is to be stored (it doesn't get smaller by deflating it).
+    With an epoch the member gets that timestamp and normalized permissions.
+    """
+    import tempfile
+    import zipfile
+    with profiled(arcname, 'compress') as record:
+        record['bytes'] = os.path.getsize(source)
+        # files dated before 1980 (mtime 0 in some build systems) get the
+        # earliest date zip can store
+        zinfo = zipfile.ZipInfo.from_file(source, arcname,
+                                          strict_timestamps=False)
+        if epoch is not None:
+            zinfo.date_time = time.gmtime(
+                min(max(epoch, 315532800), 4354819199))[:6]
+            mode = 0o755 if os.access(source, os.X_OK) else 0o644
+            zinfo.external_attr = (0o100000 | mode) << 16
+            zinfo.create_system = 3
+        chunk_size = 1024 * 1024
+        crc = 0
+        size = 0
+        if level and worth_deflating(source, zinfo.file_size):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = tempfile.SpooledTemporaryFile(max_size=4 * chunk_size)
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    data.write(compressor.compress(chunk))
+            data.write(compressor.flush())
+            if data.tell() < size:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.compress_size = data.tell()
+                zinfo.file_size = size
+                zinfo.CRC = crc
+                data.seek(0)
+                return zinfo, data
+            data.close()
+            crc = 0
+            size = 0
+
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.compress_size = zinfo.file_size = size
+        zinfo.CRC = crc
+        return zinfo, None
+
+
+def worth_deflating(source, size):
+    """
+    Guess whether deflating source will gain anything, from its extension
+    or, for large files, by compressing a few samples of it
+    """
+    if os.path.splitext(source)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    if size < SAMPLE_THRESHOLD:
+        return True
+    sample_size = 64 * 1024
+    sampled = 0
+    compressed = 0
+    with open(source, 'rb') as f:
+        for offset in (0, size // 2, size - sample_size):
+            f.seek(max(offset, 0))
+            sample = f.read(sample_size)
+            sampled += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return compressed < 0.95 * sampled
+
+
+class ZipWriter(object):
+    """
+    Writes a zip archive from members whose CRC, sizes and data, deflated
+    or stored, are already known (see compress_member); zipfile has no
+    public API for adding data compressed elsewhere. Set comment before
+    the archive is closed.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.members = []
+        self.comment = b''
 
-    #confirm = click.confirm(
-    #    'Create a packaged plugin ({0}.zip) from the deployed files?'.format(name))
-    #confirm = True
-    if proceed:
-        # delete the zip if it exists
-        if os.path.exists('{0}.zip'.format(name)):
-            os.unlink('{0}.zip'.format(name))
-        if name:
-            cwd = os.getcwd()
-            os.chdir(get_plugin_directory())
-            # click.secho("Current directory is {}".format(os.getcwd()), fg='magenta')
-            if use_7z:
-                subprocess.check_call(
-                    [zip, 'a', '-r', os.path.join(cwd, '{0}.zip'.format(name)),
-                     name])
-            else:
-                subprocess.check_call([
-                    zip, '-r', os.path.join(cwd, '{0}.zip'.format(name)), name
-                ])
+    def __enter__(self):
+        return self
 
-            print(
-                'The {0}.zip archive has been created in the current directory'.format(
-                    name))
+    def __exit__(self, kind, value, traceback):
+        try:
+            if kind is None:
+                self.write_directory()
+        finally:
+            self.file.close()
+
+    def write(self, zinfo, data):
+        """
+        Append the member described by zinfo, copying its data from data,
+        a file object (which is closed) or the path of the file to store
+        """
+        offset = self.file.tell()
+        name, flags = zip_name_bytes(zinfo.filename)
+        extra = b''
+        version = 20
+        if zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT:
+            extra = struct.pack('<HHQQ', 1, 16, zinfo.file_size,
+                                zinfo.compress_size)
+            version = 45
+        self.file.write(struct.pack(
+            '<4s2B4HL2L2H', b'PK\x03\x04', version, 0, flags,
+            zinfo.compress_type, *dos_date_time(zinfo.date_time) +
+            (zinfo.CRC, 0xffffffff if extra else zinfo.compress_size,
+             0xffffffff if extra else zinfo.file_size, len(name), len(extra))))
+        self.file.write(name + extra)
+        if isinstance(data, str):
+            with open(data, 'rb') as f:
+                shutil.copyfileobj(f, self.file, 1024 * 1024)
         else:
-            click.echo(
-                "Your config file is missing the plugin name (name=parameter)")
+            shutil.copyfileobj(data, self.file, 1024 * 1024)
+            data.close()
+        self.members.append((zinfo, offset))
+
+    def write_directory(self):
+        start = self.file.tell()
+        for zinfo, offset in self.members:
+            name, flags = zip_name_bytes(zinfo.filename)
+            sizes = [zinfo.file_size, zinfo.compress_size, offset]
+            large = [value for value in sizes if value > ZIP64_LIMIT]
+            extra = b''
+            if large:
+                extra = struct.pack('<HH{0}Q'.format(len(large)), 1,
+                                    8 * len(large), *large)
+                sizes = [0xffffffff if value > ZIP64_LIMIT else value
+                         for value in sizes]
+            version = 45 if large else 20
+            self.file.write(struct.pack(
+                '<4s4B4HL2L5H2L', b'PK\x01\x02', version,
+                zinfo.create_system, version, 0, flags, zinfo.compress_type,
+                *dos_date_time(zinfo.date_time) +
+                (zinfo.CRC, sizes[1], sizes[0], len(name), len(extra), 0, 0,
+                 0, zinfo.external_attr, sizes[2])))
+            self.file.write(name + extra)
+        end = self.file.tell()
+        count = len(self.members)
+        size = end - start
+        if (count > ZIP_MAX_FILES or size > ZIP64_LIMIT or
+                start > ZIP64_LIMIT):
+            self.file.write(struct.pack(
+                '<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count,
+                size, start))
+            self.file.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1))
+            count = min(count, 0xffff)
+            size = min(size, 0xffffffff)
+            start = min(start, 0xffffffff)
+        comment = self.comment[:0xffff]
+        self.file.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count,
+                                    count, size, start, len(comment)))
+        self.file.write(comment)
+
+
+def zip_name_bytes(name):
+    """ The encoded member name and the flag bits that go with it """
+    try:
+        return name.encode('ascii'), 0
+    except UnicodeEncodeError:
+        return name.encode('utf-8'), 0x800
+
+
+def dos_date_time(date_time):
+    """ The (time, date) fields of a zip header for a date_time tuple """
+    year, month, day, hour, minute, second = date_time
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)
 
 
 @cli.command()
@@ -445,10 +2472,10 @@ def zip(config, quick):
 def validate(config):
     """
     Check the pb_tool.cfg file for mandatory sections/files.
-    Detect the plugin install path and presence of a suitable zip utilty.
+    Detect the plugin install path.
     """
     valid = True
-    cfg = get_config(config)
+    cfg = Project(config).cfg
     if not check_cfg(cfg, 'plugin', 'name'):
         valid = False
     if not check_cfg(cfg, 'files', 'python_files'):
@@ -473,30 +2500,15 @@ def validate(config):
             fg='green')
     else:
         click.secho("Your {0} file is invalid".format(config), fg='red')
-    try:
-        from PyQt5.QtCore import QStandardPaths, QDir
-        path = QStandardPaths.standardLocations(QStandardPaths.AppDataLocation)[0]
-        plugin_path = os.path.join(QDir.homePath(), path, 'QGIS/QGIS3/profiles/default/python/plugins')
+    plugin_path = qgis_plugin_directory(
+        (cfg.get('plugin', 'profile', fallback='').split() or ['default'])[0])
+    if plugin_path:
         click.secho("Plugin path: {}".format(plugin_path), fg='green')
-    except:
+    else:
         click.secho("""Unable to determine location of your QGIS Plugin directory.
         Make sure your QGIS environment is setup properly for development and Python
-        has access to the PyQt4.QtCore module.""", fg='red')
-
-    zipbin = find_zip()
-    a7z = find_7z()
-    if zipbin:
-        zip_utility = zipbin
-    elif a7z:
-        zip_utility = a7z
-    else:
-        zip_utility = None
-    if not zip_utility:
-        click.secho('zip or 7z not found. Unable to package the plugin',
-                    fg='red')
-        click.secho('Check your path or install a zip program', fg='red')
-    else:
-        click.secho('Found suitable zip utility: {}'.format(zip_utility), fg='green')
+        has access to the PyQt5.QtCore module.""", fg='red')
+
     # check for templates - uncomment next 4 after create function is done
     #print(__file__)
     #print("Module: {}".format (sys.modules['pb_tool']))
@@ -560,6 +2572,7 @@ def config(name, package):
     """
     Create a config file based on source files in the current directory
     """
+    from string import Template
     click.secho("Create a config file based on source files in the current directory", fg="green")
     if name == 'pb_tool.cfg':
         click.secho("This will overwrite any existing pb_tool.cfg in the current directory", fg="red")
@@ -574,28 +2587,25 @@ def config(name, package):
     else:
         cfg_name = name
 
-    # get the list of python files
-    py_files = glob.glob('*.py')
+    # everything is looked up in one listing of the project
+    index = SourceIndex()
+
+    # get the list of python files and the packages they are in
+    py_files = index.glob('*.py') + [
+        os.path.dirname(init) for init in index.glob('*/__init__.py')]
 
     # guess the main dialog ui file
-    main_dlg = glob.glob('*_dialog_base.ui')
+    main_dlg = index.glob('*_dialog_base.ui')
 
     # get the other ui files
-    other_ui = glob.glob('*.ui')
-    # remove the main dialog file
-    try:
-        for ui in main_dlg:
-            other_ui.remove(ui)
-    except:
-        # don't care if we didn't find it
-        pass
+    other_ui = [ui for ui in index.glob('*.ui') if ui not in main_dlg]
 
     # get the resource files (.qrc)
-    resources = glob.glob("*.qrc")
+    resources = index.glob('*.qrc')
 
-    extras = glob.glob('*.png') + glob.glob('metadata.txt')
+    extras = index.glob('*.png') + index.glob('metadata.txt')
 
-    locale_list = glob.glob('i18n/*.ts')
+    locale_list = index.glob('i18n/*.ts')
     locales = []
     for locale in locale_list:
         locales.append(os.path.basename(locale))
@@ -623,6 +2633,8 @@ def config(name, package):
 @cli.command()
 def update():
     """ Check for update to pb_tool """
+    import urllib.request
+    import urllib.error
     try:
         u = urllib.request.urlopen('http://geoapt.net/pb_tool/current3_version.txt')
         version = str(u.read()[:-1], 'utf-8')
@@ -645,13 +2657,91 @@ def update():
         click.secho("%s" % uoops.reason)
 
 
+@cli.command()
+def tools():
+    """ Show the external tools pb_tool found and their versions """
+    from concurrent.futures import ThreadPoolExecutor
+    found = find_tools()
+    with ThreadPoolExecutor(max_workers=len(found)) as pool:
+        versions = dict(
+            (name, pool.submit(tool_output, path, TOOLS[name]))
+            for name, path in found.items() if path)
+    for name, path in found.items():
+        if path:
+            click.secho('{0:<14}{1}'.format(name, path), fg='green')
+            version = version_line(versions[name].result())
+            if version:
+                print('{0:<14}{1}'.format('', version))
+        else:
+            click.secho('{0:<14}not found'.format(name), fg='red')
+
+    uic = load_uic()
+    if uic:
+        click.secho('{0:<14}in-process, {1}'.format(
+            'PyQt5.uic', uic_version().split()[-1]), fg='green')
+    else:
+        click.secho('{0:<14}not available'.format('PyQt5.uic'), fg='red')
+
+
+@cli.group(cls=AliasedGroup)
+def cache():
+    """ Show or trim the build cache of compiled ui and resource files """
+    pass
+
+
+@cache.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+def stats(config):
+    """ Show the size and location of the build cache """
+    build_cache = BuildCache.from_config(Project(config).cfg)
+    entries = build_cache.entries()
+    click.secho("Build cache: {0}".format(
+        os.path.abspath(build_cache.directory)), fg='green')
+    if not build_cache.enabled:
+        click.secho("The build cache is disabled in {0}".format(config),
+                    fg='yellow')
+    print("Entries: {0}".format(len(entries)))
+    print("Size: {0} of {1}".format(
+        format_size(sum(entry[1] for entry in entries)),
+        format_size(build_cache.max_size)))
+    if entries:
+        print("Least recently used: {0}".format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(entries[0][2]))))
+
+
+@cache.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--max-size',
+              default=None,
+              help='Trim the cache to this size (e.g. 100M) instead of the configured size')
+@click.option('--all', 'remove_all',
+              is_flag=True,
+              help='Remove every entry')
+def prune(config, max_size, remove_all):
+    """ Remove the least recently used entries from the build cache """
+    build_cache = BuildCache.from_config(Project(config).cfg)
+    if remove_all:
+        max_size = 0
+    elif max_size is not None:
+        max_size = parse_size(max_size)
+    removed, freed = build_cache.prune(max_size, force=True)
+    click.secho("Removed {0} entries ({1})".format(removed, format_size(freed)),
+                fg='green')
+
+
 @cli.command()
 def help():
     "Open the pb_tools web page in your default browser"
+    import webbrowser
     webbrowser.open_new('http://g-sherman.github.io/plugin_build_tool')
 
 
 def check_cfg(cfg, section, name):
+    import configparser
     try:
         cfg.get(section, name)
         return True
@@ -667,6 +2757,7 @@ def get_config(config='pb_tool.cfg'):
     """
     Read the config file pb_tools.cfg and return it
     """
+    import configparser
     if os.path.exists(config):
         cfg = configparser.ConfigParser()
         cfg.read(config)
@@ -678,94 +2769,994 @@ def get_config(config='pb_tool.cfg'):
         sys.exit(1)
 
 
-def compiled_ui(cfg):
-    #cfg = get_config(config)
+@profiled_stage('compile')
+def compile_files(project, jobs=None, only=None):
+    """
+    Compile the ui, resource and translation files that are out of date,
+    running up to
+    jobs conversions at once (default: the number of CPUs). A failed
+    conversion doesn't stop the others; the failures are reported per file
+    and returned as a list of (source, error message) tuples. If only is
+    given, just the sources affected by the paths in it are looked at.
+
+    Compiled files are kept in the build cache and restored from it when
+    the same input is compiled again with the same tool and options.
+    """
+    failures = []
+    cache = BuildCache.from_config(project.cfg, project.root)
+
+    ui_files = [project.path(ui) for ui in project.compiled_ui_files]
+    if only is not None:
+        ui_files = [ui for ui in ui_files if ui in only]
+    if ui_files or only is None:
+        failures += compile_ui_files(project, ui_files, cache, jobs)
+
+    res_files = [project.path(res) for res in project.resource_files]
+    # a resource file is also out of date if any file it lists has changed
+    dependencies = qrc_dependencies(res_files, project.path(CACHE_DIR))
+    if only is not None:
+        res_files = [res for res in res_files
+                     if res in only
+                     or only.intersection(dependencies.get(res, ()))]
+    if res_files or only is None:
+        failures += compile_resource_files(project, res_files, dependencies,
+                                           cache, jobs)
+
+    ts_files = [project.path(ts) for ts in project.translation_files]
+    if only is not None:
+        ts_files = [ts for ts in ts_files if ts in only]
+    if ts_files:
+        failures += compile_translation_files(project, ts_files, cache, jobs)
+    cache.prune()
+    return failures
+
+
+def compile_ui_files(project, ui_files, cache, jobs=None):
+    uic = load_uic()
+    if uic:
+        # uic keeps module level state, so forms are compiled one at a time;
+        # without the process startup that is still much faster
+        compiler = cache.wrap(uic_compiler(uic), uic_version)
+        return run_compilers(compiler, outdated_files(ui_files), 'UI', jobs=1)
+
+    # check to see if we have pyuic5
+    pyuic5 = project.tool('pyuic5')
+
+    if not pyuic5:
+        print("pyuic5 is not in your path---unable to compile your ui files")
+        return []
+    compiler = cache.wrap(tool_compiler(pyuic5), functools.partial(
+        tool_version, pyuic5, '--version'))
+    return run_compilers(compiler, outdated_files(ui_files), 'UI', jobs)
+
+
+def compile_resource_files(project, res_files, dependencies, cache,
+                           jobs=None):
+    cfg = project.cfg
+    outdated = outdated_files(res_files, dependencies)
+    if cfg.get('resources', 'compiler', fallback='builtin') == 'pyrcc5':
+        # check to see if we have pyrcc5
+        pyrcc5 = project.tool('pyrcc5')
+
+        if not pyrcc5:
+            click.secho(
+                "pyrcc5 is not in your path---unable to compile your resource file(s)",
+                fg='red')
+            return []
+        compiler = cache.wrap(tool_compiler(pyrcc5), functools.partial(
+            tool_version, pyrcc5, '-version'), dependencies)
+    else:
+        compress = cfg.getint('resources', 'compress', fallback=-1)
+        threshold = cfg.getint('resources', 'threshold', fallback=70)
+        compiler = cache.wrap(rcc_compiler(compress, threshold),
+                              'pb_tool rcc {0} {1} {2}'.format(
+                                  __version()[0], compress, threshold),
+                              dependencies)
+    return run_compilers(compiler, outdated, 'resource', jobs)
+
+
+def compile_translation_files(project, ts_files, cache, jobs=None):
+    """
+    Compile the outdated .ts files to .qm files concurrently, with the
+    built-in compiler unless lrelease is configured
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    outdated = outdated_files(ts_files, extension='.qm')
+    if project.cfg.get('translations', 'compiler',
+                       fallback='builtin') != 'lrelease':
+        identity = 'pb_tool qm {0}'.format(__version()[0])
+        if len(outdated) < 2 or jobs == 1:
+            # not worth starting processes for
+            return run_compilers(cache.wrap(qm_compiler(), identity),
+                                 outdated, 'translation', jobs)
+        with ProcessPoolExecutor(max_workers=min(
+                jobs or os.cpu_count(), len(outdated)),
+                mp_context=process_context()) as pool:
+            return run_compilers(cache.wrap(qm_compiler(pool), identity),
+                                 outdated, 'translation', jobs)
+
+    for binary in ('lrelease', 'lrelease-qt4'):
+        lrelease = project.tool(binary)
+        if lrelease:
+            break
+    else:
+        click.secho("Unable to find the lrelease command. Make sure it is "
+                    "installed and in your path.", fg='red')
+        if sys.platform == 'win32':
+            print('You can get lrelease by installing'
+                  ' the qt4-devel package in the Libs'
+                  '\nsection of the OSGeo4W Advanced Install.')
+        return []
+    compiler = cache.wrap(lrelease_compiler(lrelease), functools.partial(
+        tool_version, lrelease, '-version'))
+    return run_compilers(compiler, outdated, 'translation', jobs)
+
+
+def outdated_files(sources, dependencies=None, extension='.py'):
+    """
+    Return (source, output) for each source whose compiled file (source
+    with extension) is missing or older than the source or any of the files
+    listed for it in the dependencies dict.
+    """
+    dependencies = dependencies or {}
+    outdated = []
+    for source in sources:
+        if os.path.exists(source):
+            (base, ext) = os.path.splitext(source)
+            output = base + extension
+            if file_changed(source, output, dependencies.get(source, ())):
+                outdated.append((source, output))
+            else:
+                print("Skipping {0} (unchanged)".format(source))
+        else:
+            print("{0} does not exist---skipped".format(source))
+    return outdated
+
+
+@functools.lru_cache(maxsize=None)
+def load_uic():
+    """ Import PyQt5.uic once, returning None if PyQt5 isn't available """
     try:
-        uis = cfg.get('files', 'compiled_ui_files').split()
-        compiled = []
-        for ui in uis:
-            (base, ext) = os.path.splitext(ui)
-            compiled.append('{0}.py'.format(base))
-        #print "Compiled UI files: {}".format(compiled)
-        return compiled
-    except configparser.NoSectionError as oops:
-        print(oops.message)
-        sys.exit(1)
+        from PyQt5 import uic
+        return uic
+    except ImportError:
+        return None
 
 
-def compiled_resource(cfg):
-    #cfg = get_config(config)
+def uic_version():
+    """ Identify the in-process ui compiler for the build cache """
     try:
-        res_files = cfg.get('files', 'resource_files').split()
-        compiled = []
-        for res in res_files:
-            (base, ext) = os.path.splitext(res)
-            compiled.append('{0}.py'.format(base))
-        #print "Compiled resource files: {}".format(compiled)
-        return compiled
-    except configparser.NoSectionError as oops:
-        print(oops.message)
-        sys.exit(1)
+        from PyQt5.QtCore import PYQT_VERSION_STR
+    except ImportError:
+        PYQT_VERSION_STR = 'unknown'
+    return 'PyQt5.uic {0}'.format(PYQT_VERSION_STR)
+
+
+def uic_compiler(uic):
+    """
+    Return a function that compiles a .ui file in-process with PyQt5.uic
+    using the same defaults as pyuic5
+    """
+    def compile_ui(source, output):
+        try:
+            with UIC_LOCK, open(output, 'w', encoding='utf-8') as f:
+                uic.compileUi(source, f)
+        except Exception as oops:
+            if os.path.exists(output):
+                os.unlink(output)
+            return str(oops)
+        return None
+    return compile_ui
 
 
-def compile_files(cfg):
-    # Compile all ui and resource files
-    # TODO add changed detection
-    #cfg = get_config(config)
+def tool_compiler(tool):
+    """
+    Return a function that compiles a file by running tool (pyuic5 or
+    pyrcc5) as 'tool -o output source'
+    """
+    return command_compiler(lambda source, output: [tool, '-o', output, source])
 
-    # check to see if we have pyuic5
-    pyuic5 = check_path('pyuic5')
 
-    if not pyuic5:
-        print("pyuic5 is not in your path---unable to compile your ui files")
-    else:
-        ui_files = cfg.get('files', 'compiled_ui_files').split()
-        ui_count = 0
-        for ui in ui_files:
-            if os.path.exists(ui):
-                (base, ext) = os.path.splitext(ui)
-                output = "{0}.py".format(base)
-                if file_changed(ui, output):
-                    print("Compiling {0} to {1}".format(ui, output))
-                    subprocess.check_call([pyuic5, '-o', output, ui])
-                    ui_count += 1
-                else:
-                    print("Skipping {0} (unchanged)".format(ui))
+def lrelease_compiler(tool):
+    """
+    Return a function that compiles a .ts file by running tool (lrelease)
+    as 'tool source -qm output'
+    """
+    return command_compiler(
+        lambda source, output: [tool, source, '-qm', output])
+
+
+def command_compiler(command):
+    """
+    Return a function that compiles a file by running the command line
+    command(source, output) returns; its output is the error message
+    """
+    import subprocess
+    def compile_with_tool(source, output):
+        try:
+            result = subprocess.run(command(source, output),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        except OSError as oops:
+            return oops.strerror
+        return result.stdout.strip() if result.returncode else None
+    return compile_with_tool
+
+
+def tool_version(tool, flag):
+    """
+    Identify an external tool by its path and what it reports for its
+    version flag
+    """
+    return '{0} {1}'.format(os.path.realpath(tool), tool_output(tool, flag))
+
+
+@functools.lru_cache(maxsize=None)
+def tool_output(tool, flag):
+    """ What tool prints when run with flag (or no arguments if flag is None) """
+    import subprocess
+    try:
+        result = subprocess.run([tool] + ([flag] if flag else []),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True, timeout=30)
+        return result.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def version_line(output):
+    """ The first line of a tool's version output that has a version number """
+    for line in output.splitlines():
+        if re.search(r'\d+\.\d+', line):
+            return line.strip()
+    return output.splitlines()[0].strip() if output else ''
+
+
+class BuildCache(object):
+    """
+    Content-addressed store for compiled ui and resource files.
+
+    Entries are keyed by a hash of the tool identity and options, the
+    source name and the content of the source and its dependencies, so a
+    fresh clone or a branch switch that leaves a file's content unchanged
+    doesn't need to recompile it. The least recently used entries are
+    evicted once the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, directory, max_size, enabled=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.enabled = enabled
+        self.stored = False
+
+    @classmethod
+    def from_config(cls, cfg, root=''):
+        """
+        Set up the cache using the optional [cache] section of cfg, a
+        relative dir being relative to root
+        """
+        return cls(os.path.join(root, cfg.get('cache', 'dir', fallback=None)
+                                or os.path.join(CACHE_DIR, 'build')),
+                   parse_size(cfg.get('cache', 'max_size', fallback='256M')),
+                   cfg.getboolean('cache', 'enabled', fallback=True))
+
+    def key(self, identity, source, dependencies=()):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([identity, source]).encode('utf-8'))
+        for path in (source,) + tuple(dependencies):
+            digest.update(json.dumps([path, file_hash(path)]).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.py')
+
+    def get(self, key, output):
+        """ Restore the entry for key to output, returning True on a hit """
+        entry = self.path(key)
+        try:
+            replace_file(entry, output)
+            # the modification time records when an entry was last used
+            os.utime(entry)
+            return True
+        except (IOError, OSError):
+            return False
+
+    def put(self, key, output):
+        entry = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            replace_file(output, entry)
+            self.stored = True
+        except (IOError, OSError):
+            # a full or read-only cache directory; the output is in place
+            pass
+
+    def wrap(self, compiler, identity, dependencies=None):
+        """
+        Return a compiler function (see run_compilers) that restores the
+        output from the cache when possible and otherwise calls compiler
+        and stores its output. identity may be a function, which is only
+        called once something has to be compiled.
+        """
+        if not self.enabled:
+            return compiler
+        dependencies = dependencies or {}
+
+        def compile_cached(source, output):
+            try:
+                key = self.key(identity() if callable(identity) else identity,
+                               source, dependencies.get(source, ()))
+            except (IOError, OSError):
+                # let the compiler report what is missing
+                return compiler(source, output)
+            if self.get(key, output):
+                print("Restored {0} from the build cache".format(output))
+                return None
+            error = compiler(source, output)
+            if error is None:
+                self.put(key, output)
+            return error
+        return compile_cached
+
+    def entries(self):
+        """ Return (path, size, last used) for every entry, oldest first """
+        entries = []
+        if os.path.isdir(self.directory):
+            for bucket in os.scandir(self.directory):
+                if bucket.is_dir():
+                    for entry in os.scandir(bucket.path):
+                        st = entry.stat()
+                        entries.append((entry.path, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def prune(self, max_size=None, force=False):
+        """
+        Evict the least recently used entries until the cache is no larger
+        than max_size (default: the configured size). Unless force is set
+        this only happens after something was stored. Returns the number of
+        entries and bytes removed.
+        """
+        if not (force or self.stored):
+            return 0, 0
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        freed = 0
+        for path, size, used in entries:
+            if total - freed <= max_size:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+                freed += size
+            except OSError:
+                pass
+        return removed, freed
+
+
+def parse_size(size):
+    """ Convert a size such as 512K, 200M or 2G to bytes """
+    size = size.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return '{0:.0f} {1}'.format(size, unit) if unit == 'bytes' \
+        else '{0:.1f} {1}'.format(size, unit)
+
+
+def run_compilers(compiler, files, kind, jobs=None):
+    """
+    Call compiler(source, output) for each (source, output) in files using
+    a pool of jobs workers and report the outcome per file. compiler returns
+    None on success or an error message.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    count = 0
+    failures = []
+    def compile_file(source, output):
+        with profiled(source, 'compile') as record:
+            error = compiler(source, output)
+            record['bytes'] = os.path.getsize(source)
+            return error
+
+    with profiled('compile {0} files'.format(kind)), \
+            ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = {}
+        for source, output in files:
+            print("Compiling {0} to {1}".format(source, output))
+            futures[pool.submit(compile_file, source, output)] = source
+        for future in as_completed(futures):
+            source = futures[future]
+            error = future.result()
+            if error is None:
+                count += 1
             else:
-                print("{0} does not exist---skipped".format(ui))
-        print("Compiled {0} UI files".format(ui_count))
+                failures.append((source, error))
+                click.secho("Failed to compile {0}: {1}".format(source, error),
+                            fg='red')
+    print("Compiled {0} {1} files".format(count, kind))
+    if failures:
+        click.secho("{0} {1} files failed to compile".format(
+            len(failures), kind), fg='red')
+    return failures
 
-    # check to see if we have pyrcc5
-    pyrcc5 = check_path('pyrcc5')
 
-    if not pyrcc5:
-        click.secho(
-            "pyrcc5 is not in your path---unable to compile your resource file(s)",
-            fg='red')
-    else:
-        res_files = cfg.get('files', 'resource_files').split()
-        res_count = 0
-        for res in res_files:
-            if os.path.exists(res):
-                (base, ext) = os.path.splitext(res)
-                output = "{0}.py".format(base)
-                if file_changed(res, output):
-                    print("Compiling {0} to {1}".format(res, output))
-                    subprocess.check_call([pyrcc5, '-o', output, res])
-                    res_count += 1
-                else:
-                    print("Skipping {0} (unchanged)".format(res))
+def rcc_compiler(compress_level=-1, threshold=70):
+    """
+    Return a function that compiles a .qrc file in-process with the
+    built-in resource compiler (see compile_qrc)
+    """
+    def compile_resource(source, output):
+        try:
+            compile_qrc(source, output, compress_level, threshold)
+        except (IOError, OSError, ValueError) as oops:
+            if os.path.exists(output):
+                os.unlink(output)
+            return str(oops)
+        return None
+    return compile_resource
+
+
+def qrc_dependencies(qrc_files, cache_dir=CACHE_DIR):
+    """
+    Return a dict of the files listed in each of qrc_files. The lists are
+    cached in the project's .pb_tool_cache directory (cache_dir) and only
+    re-parsed when the .qrc itself or a directory it lists changes.
+    """
+    cache_file = os.path.join(cache_dir, 'qrc_deps.json')
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        cache = {}
+
+    dependencies = {}
+    modified = False
+    for qrc in qrc_files:
+        try:
+            st = os.stat(qrc)
+        except OSError:
+            continue
+        cached = cache.get(qrc)
+        if not cached or cached['mtime'] != st.st_mtime_ns \
+                or cached['size'] != st.st_size \
+                or 'dirs' not in cached \
+                or cached['dirs'] != directory_times(cached['dirs']):
+            directories = []
+            try:
+                files = sorted(set(os.path.normpath(source)
+                                   for resource, source, attributes
+                                   in read_qrc(qrc, False, directories)))
+            except ValueError:
+                # compiling it will report the problem
+                continue
+            cached = cache[qrc] = {'mtime': st.st_mtime_ns,
+                                   'size': st.st_size,
+                                   'files': files,
+                                   'dirs': directory_times(directories)}
+            modified = True
+        dependencies[qrc] = cached['files']
+
+    if modified:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+        except (IOError, OSError):
+            pass
+    return dependencies
+
+
+def directory_times(directories):
+    """
+    Map each of directories to its modification time, which changes when
+    files are added to or removed from it, or None if it is gone
+    """
+    times = {}
+    for directory in directories:
+        try:
+            times[directory] = os.stat(directory).st_mtime_ns
+        except OSError:
+            times[directory] = None
+    return times
+
+
+def read_qrc(qrc, warn=True, directories=None):
+    """
+    Parse a .qrc file and return a list of (resource path, file path,
+    attributes) for every file it lists. File paths are resolved relative
+    to the .qrc and directories are expanded to the files they contain;
+    the directories walked are added to directories if given.
+    """
+    import xml.etree.ElementTree as ElementTree
+
+    base = os.path.dirname(qrc)
+    try:
+        root = ElementTree.parse(qrc).getroot()
+    except ElementTree.ParseError as oops:
+        raise ValueError("{0}: {1}".format(qrc, oops))
+    entries = []
+    for resource in root.iter('qresource'):
+        prefix = resource.get('prefix', '/')
+        if warn and resource.get('lang'):
+            click.secho("{0}: lang attributes are not supported, {1} is "
+                        "compiled for the default locale".format(
+                            qrc, prefix), fg='yellow')
+        for element in resource.iter('file'):
+            path = (element.text or '').strip()
+            alias = element.get('alias') or path
+            source = os.path.join(base, path)
+            if os.path.isdir(source):
+                for root_dir, subdirs, files in os.walk(source):
+                    if directories is not None:
+                        directories.append(root_dir)
+                    subdirs.sort()
+                    for name in sorted(files):
+                        file_path = os.path.join(root_dir, name)
+                        rel = os.path.relpath(file_path, source)
+                        entries.append(('/'.join([prefix, alias, rel]),
+                                        file_path, element.attrib))
             else:
-                print("{0} does not exist---skipped".format(res))
-        print("Compiled {0} resource files".format(res_count))
+                entries.append(('/'.join([prefix, alias]), source,
+                                element.attrib))
+    return entries
+
+
+class ResourceNode(object):
+    """ A directory or file in the tree of a compiled resource file """
+    __slots__ = ('name', 'source', 'attributes', 'children', 'name_offset',
+                 'data_offset', 'first_child', 'compressed', 'mtime')
+
+    def __init__(self, name, source=None, attributes=None):
+        self.name = name
+        self.source = source
+        self.attributes = attributes or {}
+        self.children = {} if source is None else None
+        self.compressed = False
+
+
+def qt_hash(name):
+    """ The hash Qt uses to look up resource names (qt_hash in qhash.cpp) """
+    h = 0
+    encoded = name.encode('utf-16-be')
+    for i in range(0, len(encoded), 2):
+        h = (h << 4) + ((encoded[i] << 8) | encoded[i + 1])
+        h ^= (h & 0xf0000000) >> 23
+        h &= 0x0fffffff
+    return h
+
+
+class PyBytesWriter(object):
+    """ Write bytes to a text file as the body of a Python bytes literal """
+    HEX = ['\\x{0:02x}'.format(i) for i in range(256)]
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = b''
+
+    def write(self, data):
+        data = self.pending + data
+        full = len(data) - len(data) % 16
+        for i in range(0, full, 16):
+            self.out.write(''.join(map(self.HEX.__getitem__, data[i:i + 16])))
+            self.out.write('\\\n')
+        self.pending = data[full:]
+
+    def close(self):
+        if self.pending:
+            self.out.write(''.join(map(self.HEX.__getitem__, self.pending)))
+            self.out.write('\\\n')
+        self.pending = b''
+
+
+def compile_qrc(qrc, output, compress_level=-1, threshold=70):
+    """
+    Compile a Qt resource collection into a Python module equivalent to the
+    one written by pyrcc5.
+
+    File contents are streamed into the output rather than read into memory
+    at once. As with rcc, an entry is stored zlib-compressed at
+    compress_level (0 disables compression) when that makes it at least
+    threshold percent smaller; the compress and threshold attributes of a
+    <file> element override these for that file.
+    """
+    tree = ResourceNode('')
+    for resource_path, source, attributes in read_qrc(qrc):
+        if not os.path.isfile(source):
+            raise IOError("{0}: cannot find file {1}".format(qrc, source))
+        parts = [p for p in resource_path.split('/') if p not in ('', '.')]
+        node = tree
+        for part in parts[:-1]:
+            node = node.children.setdefault(part, ResourceNode(part))
+            if node.children is None:
+                raise ValueError("{0}: {1} is both a file and a "
+                                 "directory".format(qrc, resource_path))
+        if parts[-1] in node.children:
+            click.secho("{0}: duplicate resource {1} ignored".format(
+                qrc, resource_path), fg='yellow')
+            continue
+        node.children[parts[-1]] = ResourceNode(parts[-1], source, attributes)
+
+    # Lay the nodes out the way rcc does: the children of a directory are
+    # stored together, sorted by hash so Qt can binary search them
+    nodes = [tree]
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        node.first_child = len(nodes)
+        for child in sorted(node.children.values(),
+                            key=lambda n: qt_hash(n.name)):
+            nodes.append(child)
+            if child.children is not None:
+                pending.append(child)
+
+    with open(output, 'w') as out:
+        out.write(RCC_HEADER.format(version=__version()[0]))
+
+        out.write('qt_resource_data = b"\\\n')
+        writer = PyBytesWriter(out)
+        offset = 0
+        for node in nodes:
+            if node.children is None:
+                node.data_offset = offset
+                offset += write_resource_data(
+                    writer, node,
+                    int(node.attributes.get('compress', compress_level)),
+                    int(node.attributes.get('threshold', threshold)))
+        writer.close()
+        out.write('"\n\n')
+
+        out.write('qt_resource_name = b"\\\n')
+        names = {}
+        offset = 0
+        for node in nodes[1:]:
+            if node.name not in names:
+                names[node.name] = offset
+                encoded = node.name.encode('utf-16-be')
+                writer.write(struct.pack('>HI', len(encoded) // 2,
+                                         qt_hash(node.name)))
+                writer.write(encoded)
+                offset += 6 + len(encoded)
+            node.name_offset = names[node.name]
+        writer.close()
+        out.write('"\n\n')
+
+        for version in (1, 2):
+            out.write('qt_resource_struct_v{0} = b"\\\n'.format(version))
+            for node in nodes:
+                name_offset = node.name_offset if node is not tree else 0
+                if node.children is not None:
+                    writer.write(struct.pack('>IHII', name_offset, 0x02,
+                                             len(node.children),
+                                             node.first_child))
+                    mtime = 0
+                else:
+                    # country AnyCountry (0), language C (1)
+                    writer.write(struct.pack('>IHHHI', name_offset,
+                                             0x01 if node.compressed else 0,
+                                             0, 1, node.data_offset))
+                    mtime = node.mtime
+                if version == 2:
+                    writer.write(struct.pack('>Q', mtime))
+            writer.close()
+            out.write('"\n\n')
+
+        out.write(RCC_FOOTER)
+
+
+def write_resource_data(writer, node, compress_level, threshold):
+    """
+    Write the length-prefixed contents of a file node and return the number
+    of bytes written
+    """
+    import tempfile
+    st = os.stat(node.source)
+    node.mtime = int(st.st_mtime * 1000)
+    size = st.st_size
+    chunk_size = 1024 * 1024
+    if compress_level != 0 and size:
+        compressor = zlib.compressobj(compress_level)
+        with tempfile.SpooledTemporaryFile(max_size=chunk_size) as compressed:
+            with open(node.source, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    compressed.write(compressor.compress(chunk))
+            compressed.write(compressor.flush())
+            # qCompress prefixes the zlib stream with the uncompressed size
+            compressed_size = compressed.tell() + 4
+            if int(100.0 * (size - compressed_size) / size) >= threshold:
+                node.compressed = True
+                writer.write(struct.pack('>II', compressed_size, size))
+                compressed.seek(0)
+                for chunk in iter(lambda: compressed.read(chunk_size), b''):
+                    writer.write(chunk)
+                return 4 + compressed_size
+
+    writer.write(struct.pack('>I', size))
+    with open(node.source, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            writer.write(chunk)
+    return 4 + size
+
+
+RCC_HEADER = """# -*- coding: utf-8 -*-
+
+# Resource object code
+#
+# Created by: The Resource Compiler of pb_tool {version}
+#
+# WARNING! All changes made in this file will be lost!
+
+from PyQt5 import QtCore
+
+"""
+
+RCC_FOOTER = """qt_version = [int(v) for v in QtCore.qVersion().split('.')]
+if qt_version < [5, 8, 0]:
+    rcc_version = 1
+    qt_resource_struct = qt_resource_struct_v1
+else:
+    rcc_version = 2
+    qt_resource_struct = qt_resource_struct_v2
+
+def qInitResources():
+    QtCore.qRegisterResourceData(rcc_version, qt_resource_struct, qt_resource_name, qt_resource_data)
+
+def qCleanupResources():
+    QtCore.qUnregisterResourceData(rcc_version, qt_resource_struct, qt_resource_name, qt_resource_data)
+
+qInitResources()
+"""
+
+
+def qm_compiler(pool=None):
+    """
+    Return a function that compiles a .ts file to .qm in-process with the
+    built-in translation compiler (see compile_ts). If pool (a process
+    pool) is given the work is done there, as parsing is CPU bound.
+    """
+    def compile_translation(source, output):
+        if pool is not None:
+            return pool.submit(compile_ts_file, source, output).result()
+        return compile_ts_file(source, output)
+    return compile_translation
+
+
+def process_context():
+    """
+    The multiprocessing context for worker processes. They are started
+    from threads (in workspace builds), and forking a process that runs
+    threads can leave locks held in the child, so forkserver or spawn is
+    used instead.
+    """
+    import multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def compile_ts_file(source, output):
+    """ Run compile_ts, returning None or an error message """
+    try:
+        compile_ts(source, output)
+    except (IOError, OSError, ValueError) as oops:
+        if os.path.exists(output):
+            os.unlink(output)
+        return str(oops)
+    return None
+
+
+# Qt's .qm format: a magic number followed by tagged sections
+QM_MAGIC = bytes([0x3c, 0xb8, 0x64, 0x18, 0xca, 0xef, 0x9c, 0x95,
+                  0xcd, 0x21, 0x1c, 0xbf, 0x60, 0xa1, 0xbd, 0xdd])
+QM_HASHES, QM_MESSAGES, QM_NUMERUS_RULES, QM_LANGUAGE = 0x42, 0x69, 0x88, 0xa7
+QM_END, QM_TRANSLATION, QM_SOURCE_TEXT, QM_CONTEXT, QM_COMMENT = 1, 3, 6, 7, 8
+
+# Plural rules in QTranslator's byte code, as lrelease writes them for
+# these languages: each rule picks the next plural form if it matches n
+_EQ, _LT, _LEQ, _BETWEEN, _NOT = 0x01, 0x02, 0x03, 0x04, 0x08
+_MOD_10, _MOD_100, _AND, _OR, _NEWRULE = 0x10, 0x20, 0xfd, 0xfe, 0xff
+_NEQ, _NOT_BETWEEN, _GEQ = _NOT | _EQ, _NOT | _BETWEEN, _NOT | _LT
+NUMERUS_RULES = {
+    'english': bytes([_EQ, 1]),
+    'french': bytes([_LEQ, 1]),
+    'czech': bytes([_EQ, 1, _NEWRULE, _BETWEEN, 2, 4]),
+    'polish': bytes([_EQ, 1, _NEWRULE, _MOD_10 | _BETWEEN, 2, 4, _AND,
+                     _MOD_100 | _NOT_BETWEEN, 10, 19]),
+    'russian': bytes([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11, _NEWRULE,
+                      _MOD_10 | _BETWEEN, 2, 4, _AND,
+                      _MOD_100 | _NOT_BETWEEN, 10, 19]),
+    'lithuanian': bytes([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11,
+                         _NEWRULE, _MOD_10 | _NEQ, 0, _AND,
+                         _MOD_100 | _NOT_BETWEEN, 10, 19]),
+    'latvian': bytes([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11, _NEWRULE,
+                      _NEQ, 0]),
+    'icelandic': bytes([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11]),
+    'irish': bytes([_EQ, 1, _NEWRULE, _EQ, 2]),
+    'macedonian': bytes([_MOD_10 | _EQ, 1, _NEWRULE, _MOD_10 | _EQ, 2]),
+    'romanian': bytes([_EQ, 1, _NEWRULE, _EQ, 0, _OR,
+                       _MOD_100 | _BETWEEN, 1, 19]),
+    'slovenian': bytes([_MOD_100 | _EQ, 1, _NEWRULE, _MOD_100 | _EQ, 2,
+                        _NEWRULE, _MOD_100 | _BETWEEN, 3, 4]),
+    'arabic': bytes([_EQ, 0, _NEWRULE, _EQ, 1, _NEWRULE, _EQ, 2, _NEWRULE,
+                     _MOD_100 | _BETWEEN, 3, 10, _NEWRULE, _MOD_100 | _GEQ,
+                     11]),
+}
+NUMERUS_STYLES = dict(
+    [(lang, 'english') for lang in (
+        'af', 'am', 'as', 'az', 'bg', 'bn', 'ca', 'da', 'de', 'el', 'en',
+        'eo', 'es', 'et', 'eu', 'fi', 'fo', 'fy', 'gl', 'gu', 'ha', 'he',
+        'hi', 'hy', 'it', 'ka', 'kk', 'kn', 'ku', 'lb', 'ml', 'mn', 'mr',
+        'nb', 'ne', 'nl', 'nn', 'no', 'or', 'pa', 'ps', 'pt', 'rm', 'sq',
+        'sv', 'sw', 'ta', 'te', 'tk', 'ur', 'uz', 'yi', 'zu')] +
+    [(lang, 'french') for lang in ('fr', 'fil', 'ln', 'pt_BR', 'ti', 'wa')] +
+    [(lang, 'czech') for lang in ('cs', 'sk')] +
+    [(lang, 'russian') for lang in ('be', 'bs', 'hr', 'ru', 'sr', 'uk')] +
+    [('pl', 'polish'), ('lt', 'lithuanian'), ('lv', 'latvian'),
+     ('is', 'icelandic'), ('ga', 'irish'), ('mk', 'macedonian'),
+     ('ro', 'romanian'), ('sl', 'slovenian'), ('ar', 'arabic')])
+
+
+def numerus_rules(language):
+    """
+    Return the plural rules for a language code like de or pt_BR; languages
+    with a single form (Chinese, Japanese, Turkish...) or unknown to pb_tool
+    get none and always use the first form
+    """
+    code = language.replace('-', '_')
+    parts = code.split('_')
+    style = NUMERUS_STYLES.get('_'.join(parts[:2])) or \
+        NUMERUS_STYLES.get(parts[0].lower())
+    return NUMERUS_RULES.get(style, b'')
+
+
+def ts_text(element):
+    """
+    The text of a .ts element; control characters are written as
+    <byte value="x1b"/> and length variants are separated by U+009C
+    """
+    variants = element.findall('lengthvariant')
+    if variants:
+        return '\x9c'.join(ts_text(variant) for variant in variants)
+    text = [element.text or '']
+    for child in element:
+        if child.tag == 'byte':
+            value = child.get('value', '0')
+            text.append(chr(int(value[1:], 16) if value[:1] in 'xX'
+                            else int(value)))
+        text.append(child.tail or '')
+    return ''.join(text)
+
+
+def read_ts(ts):
+    """
+    Return the language of a Qt Linguist .ts file and the messages that
+    lrelease would include as (context, source, comment, translations)
+    tuples. The file is parsed incrementally, so large files aren't held
+    in memory as a tree.
+    """
+    import xml.etree.ElementTree as ElementTree
+    language = None
+    context = ''
+    messages = []
+    try:
+        events = ElementTree.iterparse(ts, events=('start', 'end'))
+        for event, element in events:
+            if event == 'start':
+                if element.tag == 'TS':
+                    language = element.get('language')
+                continue
+            if element.tag == 'name':
+                context = element.text or ''
+            elif element.tag == 'message':
+                translation = element.find('translation')
+                if translation is None:
+                    translation = ElementTree.Element('translation',
+                                                      type='unfinished')
+                kind = translation.get('type')
+                if kind in ('obsolete', 'vanished'):
+                    pass
+                else:
+                    forms = translation.findall('numerusform')
+                    if element.get('numerus') == 'yes' and forms:
+                        translations = [ts_text(form) for form in forms]
+                    else:
+                        translations = [ts_text(translation)]
+                    # unfinished messages without a translation are left
+                    # out so the source text is shown
+                    if kind != 'unfinished' or translations[0]:
+                        source = element.find('source')
+                        comment = element.find('comment')
+                        messages.append((
+                            context,
+                            '' if source is None else ts_text(source),
+                            '' if comment is None else ts_text(comment),
+                            translations))
+                element.clear()
+            elif element.tag == 'context':
+                element.clear()
+    except ElementTree.ParseError as oops:
+        raise ValueError("{0}: {1}".format(ts, oops))
+    return language, messages
+
+
+def elf_hash(data):
+    """ The hash QTranslator looks messages up by """
+    h = 0
+    for byte in data:
+        if not byte:
+            break
+        h = ((h << 4) + byte) & 0xffffffff
+        g = h & 0xf0000000
+        if g:
+            h ^= g >> 24
+        h &= ~g
+    return h or 1
+
+
+def compile_ts(ts, output):
+    """
+    Compile a Qt Linguist .ts file to the binary .qm format QTranslator
+    loads, as lrelease does: a table of (hash, offset) pairs sorted by hash
+    and the messages it points into, plus the language and its plural
+    rules. Obsolete and untranslated messages are left out.
+    """
+    language, messages = read_ts(ts)
+    if not language:
+        # take it from a name like de.ts, pt_BR.ts or myplugin_de.ts
+        match = re.search(r'(?:^|[_.-])([a-z]{2,3}(?:_[A-Z]{2})?)$',
+                          os.path.splitext(os.path.basename(ts))[0])
+        language = match.group(1) if match else ''
+
+    unique = {}
+    for context, source, comment, translations in messages:
+        key = (context.encode('utf-8'), source.encode('utf-8'),
+               comment.encode('utf-8'))
+        # the first of a duplicated message wins
+        unique.setdefault(key, translations)
+
+    message_data = bytearray()
+    offsets = []
+    for key in sorted(unique):
+        context, source, comment = key
+        offsets.append((elf_hash(source + comment), len(message_data)))
+        for translation in unique[key]:
+            encoded = translation.encode('utf-16-be')
+            message_data += struct.pack('>BI', QM_TRANSLATION, len(encoded))
+            message_data += encoded
+        for tag, value in ((QM_COMMENT, comment), (QM_SOURCE_TEXT, source),
+                           (QM_CONTEXT, context)):
+            message_data += struct.pack('>BI', tag, len(value)) + value
+        message_data.append(QM_END)
+
+    sections = [(QM_LANGUAGE, language.encode('utf-8'))]
+    if offsets:
+        sections.append((QM_HASHES, b''.join(
+            struct.pack('>II', h, offset) for h, offset in sorted(offsets))))
+        sections.append((QM_MESSAGES, bytes(message_data)))
+    sections.append((QM_NUMERUS_RULES, numerus_rules(language)))
+    with open(output, 'wb') as f:
+        f.write(QM_MAGIC)
+        for tag, data in sections:
+            if data:
+                f.write(struct.pack('>BI', tag, len(data)))
+                f.write(data)
 
 
 def copy(source, destination):
     """Copy files recursively.
 
-    Taken from: http://www.pythoncentral.io/
-                how-to-recursively-copy-a-directory-folder-in-python/
-
     :param source: Source directory.
     :type source: str
 
@@ -774,37 +3765,115 @@ def copy(source, destination):
 
     """
     try:
-        #shutil.copytree(source, destination)
-        copy_tree(source, destination)
+        shutil.copytree(source, destination, copy_function=copy_file,
+                        dirs_exist_ok=True)
+    except NotADirectoryError:
+        # source is a file
+        copy_file(source, destination)
     except OSError as e:
-        # If the error was caused because the source wasn't a directory
-        if e.errno == errno.ENOTDIR:
-            shutil.copy(source, destination)
-        else:
-            print('Directory not copied. Error: %s' % e)
+        print('Directory not copied. Error: %s' % e)
 
 
-def get_plugin_directory(config='pb_tool.cfg'):
-    """ Get the plugin directory, first checking to see if it's configured in pb_tool.cfg"""
-    plugin_dir = get_config(config).get('plugin', 'plugin_path', fallback=None)
-
-    if plugin_dir:
-        click.secho("Using plugin directory from pb_tool.cfg", fg='green')
-    else:
-        try:
-            from PyQt5.QtCore import QStandardPaths, QDir
-            path = QStandardPaths.standardLocations(QStandardPaths.AppDataLocation)[0]
-            plugin_dir = os.path.join(QDir.homePath(), path, 'QGIS/QGIS3/profiles/default/python/plugins')
-            # click.secho("Plugin path: {}".format(plugin_path), fg='green')
-        except:
-            click.secho("""Unable to determine location of your QGIS Plugin directory.
+def get_plugin_directories(cfg):
+    """
+    Get the plugin directories: those configured as plugin_path in
+    pb_tool.cfg, one per line, and those of the QGIS profiles listed as
+    profile. Without either the default profile's is used. Profiles whose
+    directory can't be determined are reported and left out.
+    """
+    plugin_dirs = [path.strip() for path in
+                   cfg.get('plugin', 'plugin_path', fallback='').splitlines()
+                   if path.strip()]
+    profiles = cfg.get('plugin', 'profile', fallback='').split()
+
+    if plugin_dirs:
+        click.secho("Using plugin {0} from pb_tool.cfg".format(
+            'directory' if len(plugin_dirs) == 1 else 'directories'),
+            fg='green')
+    if profiles or not plugin_dirs:
+        for profile in profiles or ['default']:
+            plugin_dir = qgis_plugin_directory(profile)
+            if plugin_dir is None:
+                click.secho("""Unable to determine location of the plugin directory of the {0} QGIS profile.
             Make sure your QGIS environment is setup properly for development and Python
-            has access to the PyQt5.QtCore module or specify plugin_path in your pb_tool.cfg.""", fg='red')
-            plugin_dir = None
+            has access to the PyQt5.QtCore module or specify plugin_path in your pb_tool.cfg.""".format(profile), fg='red')
+                continue
+            plugin_dirs.append(plugin_dir)
+
+    return plugin_dirs
+
+
+def qgis_plugin_directory(profile='default'):
+    """
+    Return the plugin directory of a QGIS profile, or None if it can't be
+    determined.
+
+    Asking QStandardPaths means importing PyQt5.QtCore, which is slow, so
+    the answer is kept in a state file in the user cache directory and only
+    looked up again when the environment it was found in changes.
+    """
+    state_file = os.path.join(user_cache_dir(), 'plugin_dirs.json')
+    key = environment_key()
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        cached = state[key][profile]
+        if isinstance(cached, str):
+            return cached
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        state = None
 
+    try:
+        from PyQt5.QtCore import QStandardPaths, QDir
+        path = QStandardPaths.standardLocations(QStandardPaths.AppDataLocation)[0]
+        plugin_dir = os.path.join(
+            QDir.homePath(), path,
+            'QGIS/QGIS3/profiles/{0}/python/plugins'.format(profile))
+    except Exception:
+        return None
+
+    # entries for other environments are dropped, they are stale
+    if not isinstance(state, dict) or not isinstance(state.get(key), dict):
+        state = {key: {}}
+    state = {key: state[key]}
+    state[key][profile] = plugin_dir
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        temp = '{0}.{1}.tmp'.format(state_file, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(temp, state_file)
+    except (IOError, OSError):
+        pass
     return plugin_dir
 
 
+def user_cache_dir():
+    """ Directory for state pb_tool keeps for the current user """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'pb_tool')
+
+
+def environment_key():
+    """
+    Fingerprint of what QStandardPaths and the PyQt5 import depend on:
+    the interpreter, its module search path and the user's directories.
+    """
+    names = ('HOME', 'USERPROFILE', 'APPDATA', 'LOCALAPPDATA',
+             'XDG_DATA_HOME', 'XDG_DATA_DIRS', 'PYTHONPATH', 'PYTHONHOME',
+             'QGIS_PREFIX_PATH')
+    identity = [sys.executable, sys.version, sys.platform, sys.path[1:],
+                [os.environ.get(name) for name in names]]
+    return hashlib.sha256(
+        json.dumps(identity).encode('utf-8')).hexdigest()[:16]
+
+
 def config_template():
     """
     :return: the template for a pb_tool.cfg file
@@ -814,7 +3883,9 @@ def config_template():
 # already set below.
 #
 # As you add Python source files and UI files to your plugin, add
-# them to the appropriate [files] section below.
+# them to the appropriate [files] section below. Glob patterns such as
+# **/*.py and directories (standing for the files of that kind below
+# them) can be used in the file lists.
 
 [plugin]
 # Name of the plugin. This is the name of the directory that will
@@ -826,6 +3897,10 @@ name: $Name
 # the path.
 plugin_path:
 
+# QGIS user profiles to deploy to as well, separated by spaces. If
+# neither this nor plugin_path is set, the default profile is used.
+profile:
+
 [files]
 # Python  files that should be deployed with the plugin
 python_files: $PythonFiles
@@ -846,6 +3921,11 @@ extras: $Extras
 # These must be subdirectories under the plugin directory
 extra_dirs:
 
+# Files and directories never to deploy or package, with .gitignore
+# semantics. Patterns for a single directory go in an [exclude] section:
+# data: fixtures/ *.bak
+exclude: __pycache__/ *.pyc *~ .git/
+
 # ISO code(s) for any locales (translations), separated by spaces.
 # Corresponding .ts files must exist in the i18n directory
 locales: $Locales
@@ -861,47 +3941,90 @@ target: help
 
 
 def check_path(app):
-    """ Adapted from StackExchange:
-        http://stackoverflow.com/questions/377017
-    """
-    import os
+    """ Return the path of the executable app would run, or None """
+    if os.path.dirname(app):
+        if os.path.isfile(app) and os.access(app, os.X_OK):
+            return app
+        return None
+    return find_tools((app,))[app]
 
-    def is_exe(fpath):
-        return os.path.exists(fpath) and os.access(fpath, os.X_OK)
 
-    def ext_candidates(fpath):
-        yield fpath
-        for ext in os.environ.get("PATHEXT", "").split(os.pathsep):
-            yield fpath + ext
+def find_tools(names=tuple(TOOLS)):
+    """
+    Return a dict mapping each of names to the path of the executable that
+    would be run for it, or None if it isn't on the PATH.
+
+    The PATH is walked once for all of TOOLS and names, listing each
+    directory with os.scandir rather than probing every name and PATHEXT
+    suffix. The result is kept in tools.json in the user cache directory,
+    keyed by PATH and PATHEXT, and reused until the mtime of one of the
+    PATH directories changes (installing or removing a tool changes it).
+    """
+    search = [directory for directory
+              in os.environ.get('PATH', '').split(os.pathsep) if directory]
+    pathext = os.environ.get('PATHEXT', '')
+    extensions = [''] + [ext for ext in pathext.split(os.pathsep) if ext]
+    mtimes = []
+    for directory in search:
+        try:
+            mtimes.append(os.stat(directory).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    key = [os.pathsep.join(search), pathext]
 
-    fpath, fname = os.path.split(app)
-    if fpath:
-        if is_exe(app):
-            return app
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            exe_file = os.path.join(path, app)
-            for candidate in ext_candidates(exe_file):
-                if is_exe(candidate):
-                    return candidate
+    state_file = os.path.join(user_cache_dir(), 'tools.json')
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        known = state['tools']
+        if (state['key'] == key and state['mtimes'] == mtimes and
+                all(name in known for name in names)):
+            return dict((name, known[name]) for name in names)
+        wanted = set(known) if state['key'] == key else set()
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        wanted = set()
+    wanted.update(TOOLS, names)
+
+    found = {}
+    for directory in search:
+        try:
+            with os.scandir(directory) as entries:
+                available = dict((os.path.normcase(entry.name), entry.path)
+                                 for entry in entries)
+        except OSError:
+            continue
+        for name in wanted.difference(found):
+            for ext in extensions:
+                path = available.get(os.path.normcase(name + ext))
+                if path and os.path.isfile(path) and os.access(path, os.X_OK):
+                    found[name] = path
+                    break
+        if len(found) == len(wanted):
+            break
 
-    return None
+    tools = dict((name, found.get(name)) for name in wanted)
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        temp = '{0}.{1}.tmp'.format(state_file, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({'key': key, 'mtimes': mtimes, 'tools': tools}, f,
+                      indent=1, sort_keys=True)
+        os.replace(temp, state_file)
+    except (IOError, OSError):
+        pass
+    return dict((name, tools[name]) for name in names)
 
 
-def file_changed(infile, outfile):
+def file_changed(infile, outfile, dependencies=()):
+    """
+    Return True if outfile is missing or older than infile or any of the
+    dependencies
+    """
     try:
-        infile_s = os.stat(infile)
-        outfile_s = os.stat(outfile)
-        return infile_s.st_mtime > outfile_s.st_mtime
+        outfile_mtime = os.stat(outfile).st_mtime
+        for source in (infile,) + tuple(dependencies):
+            if os.stat(source).st_mtime > outfile_mtime:
+                return True
+        return False
     except:
         return True
-
-def find_zip():
-    # check to see if we can find zip 
-    zip = check_path('zip')
-    return zip
-
-def find_7z():
-    # check for 7z
-    zip = check_path('7z')
-    return zip
@@ -1,12 +1,65 @@
+import ast
+import errno
+import importlib.util
+import json
 import os
+import struct
+import sys
+import zipfile
+import zlib
 
 import click
+import pytest
 from click.testing import CliRunner
 from pb_tool import pb_tool
 
 runner = CliRunner()
 
 
+@pytest.fixture(autouse=True)
+def user_cache(tmp_path, monkeypatch):
+    """ Keep the per user state pb_tool writes out of the real cache """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+PLUGIN_CFG = """[plugin]
+name: testplugin
+plugin_path: {plugin_path}
+
+[files]
+python_files: {python_files}
+main_dialog:
+compiled_ui_files:
+resource_files:
+extras: metadata.txt
+extra_dirs: data
+locales:
+
+[help]
+dir: help/build/html
+target: help
+"""
+
+
+def make_plugin(plugin_path, python_files='__init__.py plugin.py'):
+    """ Write a minimal plugin and its config into the current directory """
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(PLUGIN_CFG.format(plugin_path=plugin_path,
+                                  python_files=python_files))
+    for name in ('__init__.py', 'plugin.py', 'metadata.txt'):
+        with open(name, 'w') as f:
+            f.write('# {}\n'.format(name))
+    os.makedirs(os.path.join('data', 'sub'), exist_ok=True)
+    with open(os.path.join('data', 'sub', 'points.csv'), 'w') as f:
+        f.write('x,y\n1,2\n')
+
+
+def make_help():
+    """ Write the built help of the plugin made by make_plugin """
+    os.makedirs(os.path.join('help', 'build', 'html'), exist_ok=True)
+    with open(os.path.join('help', 'build', 'html', 'index.html'), 'w') as f:
+        f.write('<html></html>\n')
+
+
 def test_validate():
     result = runner.invoke(pb_tool.cli, ['validate'])
     assert result.exit_code == 0
@@ -45,12 +98,1222 @@ def test_deploy():
     result = runner.invoke(pb_tool.cli, ['deploy'], input='y\n')
     assert result.exit_code == 0
 
+def test_project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('resource_files:', 'resource_files: resources.qrc')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    project = pb_tool.Project()
+    assert project.name == 'testplugin'
+    assert project.install_files == ['__init__.py', 'plugin.py', 'resources.py',
+                                     'metadata.txt']
+    assert project.plugin_dir == os.path.join(str(tmp_path / 'plugins'),
+                                              'testplugin')
+    assert not hasattr(project, '__dict__')
+
+
+def test_file_list_patterns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins, python_files='*.py core')
+    for name in ('core/__init__.py', 'core/algorithms/buffer.py',
+                 'core/__pycache__/buffer.cpython-311.pyc',
+                 'core/notes.txt', 'gui/forms/main.ui', '.git/hooks/x.py'):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'w') as f:
+            f.write('# {}\n'.format(name))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('extras: metadata.txt',
+                               'extras: metadata.txt **/*.txt')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+
+    project = pb_tool.Project()
+    assert project.python_files == [
+        '__init__.py', 'plugin.py', os.path.join('core', '__init__.py'),
+        os.path.join('core', 'algorithms', 'buffer.py')]
+    assert project.extras == ['metadata.txt',
+                              os.path.join('core', 'notes.txt')]
+    assert project.index.glob('**/*.ui') == [
+        os.path.join('gui', 'forms', 'main.ui')]
+    assert project.index.glob('gui/*.ui') == []
+
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert 'Copied 7 files' in result.output
+    assert os.path.exists(os.path.join(plugins, 'testplugin', 'core',
+                                       'algorithms', 'buffer.py'))
+
+
+def test_exclude(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins, python_files='**/*.py')
+    make_help()
+    for name in ('data/__pycache__/x.cpython-311.pyc', 'data/sub/x.bak',
+                 'data/sub/important.bak', 'data/fixtures/big.csv',
+                 'tests/test_plugin.py', 'fixtures.csv'):
+        os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+        with open(name, 'w') as f:
+            f.write('# {}\n'.format(name))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('locales:', 'locales:\n'
+                               'exclude: __pycache__/ *.pyc /tests')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg + '[exclude]\ndata: fixtures/ *.bak !important.bak\n')
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir',
+                        lambda path: scanned.append(path) or scandir(path))
+    project = pb_tool.Project()
+    assert project.python_files == ['__init__.py', 'plugin.py']
+    assert not [path for path in scanned if 'tests' in path]
+    targets = [target for source, target
+               in pb_tool.get_install_entries(project)]
+    assert sorted(targets) == [os.path.join(*name.split('/')) for name in (
+        '__init__.py', 'data/sub/important.bak', 'data/sub/points.csv',
+        'help/index.html', 'metadata.txt', 'plugin.py')]
+
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert result.exit_code == 0
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        assert not [name for name in archive.namelist()
+                    if 'pyc' in name or 'fixtures' in name]
+
+
+def test_import_is_lazy():
+    import subprocess
+    code = ('import sys; from pb_tool import pb_tool; '
+            'print(sorted(set(sys.argv[1:]) & set(sys.modules)))')
+    heavy = ['urllib.request', 'distutils', 'zipfile', 'configparser',
+             'concurrent.futures', 'webbrowser', 'PyQt5']
+    output = subprocess.check_output([sys.executable, '-c', code] + heavy,
+                                     cwd=os.path.dirname(__file__) or '.')
+    assert output.strip() == b'[]'
+
+
+def test_plugin_directory_state(tmp_path, monkeypatch):
+    class QStandardPaths:
+        AppDataLocation = 17
+        calls = 0
+
+        @classmethod
+        def standardLocations(cls, location):
+            cls.calls += 1
+            return [str(tmp_path / 'share')]
+
+    qtcore = type(sys)('PyQt5.QtCore')
+    qtcore.QStandardPaths = QStandardPaths
+    qtcore.QDir = type('QDir', (), {'homePath': staticmethod(lambda: '/')})
+    monkeypatch.setitem(sys.modules, 'PyQt5', type(sys)('PyQt5'))
+    monkeypatch.setitem(sys.modules, 'PyQt5.QtCore', qtcore)
+
+    expected = os.path.join(
+        str(tmp_path / 'share'), 'QGIS/QGIS3/profiles/dev/python/plugins')
+    assert pb_tool.qgis_plugin_directory('dev') == expected
+    assert pb_tool.qgis_plugin_directory('dev') == expected
+    assert QStandardPaths.calls == 1
+    assert os.path.exists(str(tmp_path / 'cache' / 'pb_tool' /
+                              'plugin_dirs.json'))
+
+    # a different environment (here a different data directory) asks again
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmp_path / 'data'))
+    assert pb_tool.qgis_plugin_directory('dev') == expected
+    assert QStandardPaths.calls == 2
+
+
+def test_install_keeps_files_that_failed_to_copy(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    project = pb_tool.Project()
+    assert pb_tool.install_files(project)
+    deployed = os.path.join(plugins, 'testplugin')
+
+    def fail(source, destination):
+        raise OSError(errno.EIO, 'Input/output error')
+
+    monkeypatch.setattr(pb_tool, 'replace_file', fail)
+    with open('plugin.py', 'w') as f:
+        f.write('# version 2\n')
+    assert not pb_tool.install_files(project, changed={'plugin.py'})
+    with open(os.path.join(deployed, 'plugin.py')) as f:
+        assert f.read() == '# plugin.py\n'
+    assert 'plugin.py' in pb_tool.read_manifest(deployed)
+
+
+def test_deploy_incremental(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y'])
+    assert result.exit_code == 0
+    assert 'Copied 4 files, 0 unchanged, 0 removed' in result.output
+    deployed = os.path.join(plugins, 'testplugin')
+    assert os.path.exists(os.path.join(deployed, 'data', 'sub', 'points.csv'))
+
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y'])
+    assert 'Copied 0 files, 4 unchanged, 0 removed' in result.output
+
+    make_plugin(plugins, python_files='__init__.py')
+    with open('metadata.txt', 'w') as f:
+        f.write('name=changed\n')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y'])
+    assert 'Copied 1 files, 2 unchanged, 1 removed' in result.output
+    assert not os.path.exists(os.path.join(deployed, 'plugin.py'))
+
+    os.unlink('__init__.py')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-j', '2'])
+    assert 'ERRORS:\nError copying files: __init__.py' in result.output
+
+
+def test_profile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    result = runner.invoke(pb_tool.cli, ['--trace', 'trace.json',
+                                         '--profile-top', '2',
+                                         'deploy', '-y', '-q'])
+    assert result.exit_code == 0
+    assert 'Stage' in result.output and 'install' in result.output
+    assert 'Slowest 2 of 5 files' in result.output
+    assert pb_tool.PROFILER is None
+    with open('trace.json') as f:
+        events = json.load(f)['traceEvents']
+    assert all(event['ph'] == 'X' for event in events)
+    copies = [event for event in events if event['cat'] == 'copy']
+    assert sorted(event['name'] for event in copies) == [
+        '__init__.py', 'data/sub/points.csv', 'help/build/html',
+        'metadata.txt', 'plugin.py']
+    assert [event['args']['bytes'] for event in copies
+            if event['name'] == 'plugin.py'] == [len('# plugin.py\n')]
+    # stages count the bytes of the files processed while they ran
+    install = [event for event in events if event['name'] == 'install']
+    assert install[0]['args']['bytes'] == 49
+    root = [event for event in events if event['name'] == 'deploy']
+    assert root and root[0]['dur'] >= max(event['dur'] for event in copies)
+
+
+def test_bytecode(tmp_path, monkeypatch):
+    import importlib.util
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    make_help()
+    deployed = os.path.join(plugins, 'testplugin')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '-b'])
+    assert 'Byte-compiled 2 files, 0 unchanged' in result.output
+    pyc = importlib.util.cache_from_source(os.path.join(deployed,
+                                                        'plugin.py'))
+    with open(pyc, 'rb') as f:
+        # checked hash-based by default
+        assert struct.unpack('<I', f.read(8)[4:])[0] == 0b11
+
+    # only the changed module is compiled again
+    with open('plugin.py', 'w') as f:
+        f.write('VERSION = 2\n')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '-b'])
+    assert 'Byte-compiled 1 files, 1 unchanged' in result.output
+    assert pb_tool.pyc_current(os.path.join(deployed, 'plugin.py'), pyc,
+                               'checked-hash')
+
+    with open('pb_tool.cfg', 'a') as f:
+        f.write('[bytecode]\nenabled: true\noptimize: 0 2\n'
+                'invalidation: unchecked-hash\n')
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert 'Byte-compiled 4 files, 0 unchanged' in result.output
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        name = 'testplugin/__pycache__/plugin.{0}.opt-2.pyc'.format(
+            sys.implementation.cache_tag)
+        assert struct.unpack('<I', archive.read(name)[4:8])[0] == 0b01
+
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('optimize: 0 2', 'optimize: 3')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert result.exit_code == 2
+    assert 'optimize in [bytecode] must list levels' in result.output
+
+
+def test_deploy_staged_and_rollback(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    deployed = os.path.join(plugins, 'testplugin')
+    runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    first = os.stat(deployed).st_ino
+
+    with open('plugin.py', 'w') as f:
+        f.write('# version 2\n')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert 'Copied 1 files, 3 unchanged, 0 removed' in result.output
+    # the new version was built next to the old one and swapped in
+    assert os.stat(deployed).st_ino != first
+    assert sorted(os.listdir(plugins)) == ['.testplugin.pb_tool-previous',
+                                           'testplugin']
+    previous = os.path.join(plugins, '.testplugin.pb_tool-previous')
+    with open(os.path.join(previous, 'plugin.py')) as f:
+        assert f.read() == '# plugin.py\n'
+
+    result = runner.invoke(pb_tool.cli, ['rollback'])
+    assert result.exit_code == 0
+    with open(os.path.join(deployed, 'plugin.py')) as f:
+        assert f.read() == '# plugin.py\n'
+    runner.invoke(pb_tool.cli, ['rollback'])
+    with open(os.path.join(deployed, 'plugin.py')) as f:
+        assert f.read() == '# version 2\n'
+
+    # a failed copy leaves the deployed plugin alone
+    def full_disk(source, destination):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(pb_tool, 'copy_file', full_disk)
+    with open('plugin.py', 'w') as f:
+        f.write('# version 3\n')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert 'Error copying files: plugin.py, No space left on device' \
+        in result.output
+    assert 'Deployment failed' in result.output
+    with open(os.path.join(deployed, 'plugin.py')) as f:
+        assert f.read() == '# version 2\n'
+    assert not os.path.exists(
+        os.path.join(plugins, '.testplugin.pb_tool-staging'))
+
+    runner.invoke(pb_tool.cli, ['dclean'], input='y\n')
+    assert os.listdir(plugins) == []
+
+
+def test_deploy_stages_only_tracked_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    deployed = os.path.join(plugins, 'testplugin')
+    runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '-b'])
+    pyc = importlib.util.cache_from_source(os.path.join(deployed, 'plugin.py'))
+    # left by an older deploy, or by hand
+    for name in ('stale.txt', os.path.join('__pycache__', 'gone.cpython-30.pyc')):
+        with open(os.path.join(deployed, name), 'w') as f:
+            f.write('stale\n')
+
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '-b'])
+    assert 'Copied 0 files, 4 unchanged, 0 removed' in result.output
+    assert 'Byte-compiled 0 files, 2 unchanged' in result.output
+    assert os.path.exists(pyc)
+    assert not os.path.exists(os.path.join(deployed, 'stale.txt'))
+    assert not os.path.exists(os.path.join(deployed, '__pycache__',
+                                           'gone.cpython-30.pyc'))
+
+    # without hard links the plugin directory is updated in place
+    monkeypatch.setattr(pb_tool, 'supports_hard_links', lambda path: False)
+    inode = os.stat(deployed).st_ino
+    with open('plugin.py', 'w') as f:
+        f.write('# version 2\n')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert "doesn't support hard links" in result.output
+    assert 'Copied 1 files, 3 unchanged, 0 removed' in result.output
+    assert os.stat(deployed).st_ino == inode
+    with open(os.path.join(deployed, 'plugin.py')) as f:
+        assert f.read() == '# version 2\n'
+
+
+@pytest.mark.parametrize('platform', [sys.platform, 'other'])
+def test_swap_dirs(tmp_path, monkeypatch, platform):
+    monkeypatch.setattr(sys, 'platform', platform)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'name').write_text('a')
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'name').write_text('b')
+    pb_tool.swap_dirs(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert (tmp_path / 'a' / 'name').read_text() == 'b'
+    assert (tmp_path / 'b' / 'name').read_text() == 'a'
+    assert sorted(os.listdir(str(tmp_path))) == ['a', 'b']
+
+
+def test_deploy_multiple_targets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    make_plugin('\n    '.join([first, second]))
+    assert pb_tool.Project().plugin_dirs == [
+        os.path.join(first, 'testplugin'), os.path.join(second, 'testplugin')]
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert result.output.count('Copied 4 files, 0 unchanged') == 2
+    for plugins in (first, second):
+        assert os.path.exists(os.path.join(plugins, 'testplugin',
+                                           'plugin.py'))
+
+    # a changed file is hashed once however many targets it goes to
+    hashed = []
+    file_hash = pb_tool.file_hash
+    monkeypatch.setattr(pb_tool, 'file_hash',
+                        lambda path: hashed.append(path) or file_hash(path))
+    with open('plugin.py', 'w') as f:
+        f.write('# version 2\n')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert result.output.count('Copied 1 files, 3 unchanged') == 2
+    assert hashed == ['plugin.py']
+
+    # plugin_path on the command line replaces the configured ones
+    third = str(tmp_path / 'third')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q',
+                                         '-p', second, '-p', third])
+    assert 'Copied 0 files, 4 unchanged' in result.output
+    assert 'Copied 4 files, 0 unchanged' in result.output
+    assert os.path.exists(os.path.join(third, 'testplugin', 'plugin.py'))
+
+
+@pytest.mark.parametrize('pyqt', [True, False])
+def test_plugin_path_and_profile(tmp_path, monkeypatch, pyqt):
+    if pyqt:
+        qtcore = type(sys)('PyQt5.QtCore')
+        qtcore.QStandardPaths = type('QStandardPaths', (), {
+            'AppDataLocation': 17,
+            'standardLocations': staticmethod(
+                lambda location: [str(tmp_path / 'share')])})
+        qtcore.QDir = type('QDir', (), {'homePath': staticmethod(lambda: '/')})
+        monkeypatch.setitem(sys.modules, 'PyQt5', type(sys)('PyQt5'))
+        monkeypatch.setitem(sys.modules, 'PyQt5.QtCore', qtcore)
+    else:
+        monkeypatch.setitem(sys.modules, 'PyQt5', None)
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    # plugin_path replaces the default profile's directory
+    assert pb_tool.Project().plugin_paths == [plugins]
+
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('plugin_path:', 'profile: testing\nplugin_path:')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    profile = os.path.join(str(tmp_path / 'share'),
+                           'QGIS/QGIS3/profiles/testing/python/plugins')
+    # a profile listed on purpose is used as well, if it can be found
+    assert pb_tool.Project().plugin_paths == (
+        [plugins, profile] if pyqt else [plugins])
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join(plugins, 'testplugin', 'plugin.py'))
+    assert os.path.exists(os.path.join(profile, 'testplugin')) == pyqt
+
+
+def test_workspace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    for name in ('alpha', 'beta'):
+        os.mkdir(str(tmp_path / name))
+        monkeypatch.chdir(tmp_path / name)
+        make_plugin(plugins)
+        make_help()
+        with open('pb_tool.cfg') as f:
+            cfg = f.read().replace('testplugin', name)
+        with open('pb_tool.cfg', 'w') as f:
+            f.write(cfg)
+    monkeypatch.chdir(tmp_path)
+
+    # the plugins are found and each one is packaged in its own directory
+    result = runner.invoke(pb_tool.cli, ['-w', '.', 'zip', '-q', '-j', '4'])
+    assert result.exit_code == 0
+    assert 'zip succeeded for 2 plugins' in result.output
+    assert os.getcwd() == str(tmp_path)
+    for name in ('alpha', 'beta'):
+        with zipfile.ZipFile(os.path.join(name, name + '.zip')) as archive:
+            assert '{0}/plugin.py'.format(name) in archive.namelist()
+        # what each plugin printed is kept together
+        root = str(tmp_path / name)
+        header = result.output.index('==> {0} ({1})'.format(name, root))
+        created = result.output.index(
+            'The {0}.zip archive has been created in {1}'.format(name, root))
+        assert '==>' not in result.output[header + 3:created]
+
+    with open('workspace.cfg', 'w') as f:
+        f.write('[workspace]\nplugins: beta\njobs: 2\n')
+    install_jobs = []
+    install_files = pb_tool.install_files
+    monkeypatch.setattr(pb_tool, 'install_files', lambda *args, **kwargs:
+                        install_jobs.append(kwargs['jobs']) or
+                        install_files(*args, **kwargs))
+    result = runner.invoke(pb_tool.cli, ['-w', 'workspace.cfg', 'de', '-q'])
+    assert result.exit_code == 0
+    # copying doesn't get a share of the jobs
+    assert install_jobs == [pb_tool.COPY_JOBS]
+    assert 'deploy succeeded for 1 plugins' in result.output
+    assert os.listdir(plugins) == ['beta']
+
+    # relative plugin paths: from the config against the plugin, from the
+    # command line against the current directory
+    with open(os.path.join('alpha', 'pb_tool.cfg')) as f:
+        cfg = f.read().replace(plugins, os.path.join('..', 'relative'))
+    with open(os.path.join('alpha', 'pb_tool.cfg'), 'w') as f:
+        f.write(cfg)
+    assert pb_tool.Project(os.path.join('alpha', 'pb_tool.cfg'),
+                           root='alpha').plugin_paths == [
+        os.path.join('alpha', '..', 'relative')]
+    result = runner.invoke(pb_tool.cli, ['-w', '.', 'de', '-q'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('relative', 'alpha', 'plugin.py'))
+    result = runner.invoke(pb_tool.cli, ['-w', '.', 'de', '-q', '-p', 'cli'])
+    assert result.exit_code == 0
+    assert sorted(os.listdir('cli')) == ['alpha', 'beta']
+
+    result = runner.invoke(pb_tool.cli, ['-w', '.', 'clean'])
+    assert result.exit_code == 2
+    assert "clean can't be used with --workspace" in result.output
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs symlink rights')
+def test_symlinked_directories(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    make_help()
+    os.makedirs(str(tmp_path / 'elsewhere' / 'realdata'))
+    (tmp_path / 'elsewhere' / 'realdata' / 'big.csv').write_text('a,b\n')
+    os.symlink(str(tmp_path / 'elsewhere' / 'realdata'),
+               os.path.join('data', 'linked'))
+    # a link back up the tree is not followed
+    os.symlink(os.path.abspath('data'), os.path.join('data', 'sub', 'loop'))
+
+    targets = [target for source, target
+               in pb_tool.get_install_entries(pb_tool.Project())]
+    assert os.path.join('data', 'linked', 'big.csv') in targets
+    assert not [target for target in targets if 'loop' in target]
+
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join(plugins, 'testplugin', 'data',
+                                       'linked', 'big.csv'))
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert result.exit_code == 0
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        assert 'testplugin/data/linked/big.csv' in archive.namelist()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs symlink rights')
+@pytest.mark.parametrize('link', ['symlink', 'hardlink'])
+def test_deploy_link(tmp_path, monkeypatch, link):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    deployed = os.path.join(plugins, 'testplugin')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '--link', link])
+    assert 'Linked 4 files, 0 unchanged, 0 removed' in result.output
+    points = os.path.join(deployed, 'data', 'sub', 'points.csv')
+    assert os.path.islink(points) == (link == 'symlink')
+    assert os.path.samefile(points, os.path.join('data', 'sub', 'points.csv'))
+    assert not os.path.islink(os.path.join(deployed, 'data'))
+
+    # edits show up without deploying again
+    with open('plugin.py', 'a') as f:
+        f.write('# edited\n')
+    with open(os.path.join(deployed, 'plugin.py')) as f:
+        assert f.read().endswith('# edited\n')
+
+    make_plugin(plugins, python_files='__init__.py')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '--link', link])
+    assert 'Linked 0 files, 3 unchanged, 1 removed' in result.output
+    assert os.path.exists('plugin.py')
+    assert not os.path.lexists(os.path.join(deployed, 'plugin.py'))
+
+    # a copy deploy replaces the links with files, leaving the sources alone
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-q'])
+    assert 'Copied 3 files, 0 unchanged, 0 removed' in result.output
+    assert not os.path.islink(points)
+    runner.invoke(pb_tool.cli, ['deploy', '-y', '-q', '--link'])
+    assert os.path.islink(points)
+
+    # a linked directory inside the deployment and a linked deployment
+    os.symlink(str(tmp_path / 'data'), os.path.join(deployed, 'linked'))
+    result = runner.invoke(pb_tool.cli, ['dclean'], input='y\n')
+    assert result.exit_code == 0
+    assert not os.path.lexists(deployed)
+    os.symlink(str(tmp_path), deployed)
+    runner.invoke(pb_tool.cli, ['dclean'], input='y\n')
+    assert not os.path.lexists(deployed)
+    assert os.path.exists(os.path.join('data', 'sub', 'points.csv'))
+    assert os.path.exists('__init__.py') and os.path.exists('pb_tool.cfg')
+
+
+@pytest.mark.parametrize('unsupported', [(), ('copy_file_range',),
+                                         ('copy_file_range', 'sendfile')])
+def test_copy_file(tmp_path, monkeypatch, unsupported):
+    def fail(*args):
+        raise OSError(18, 'Invalid cross-device link')
+
+    for method in unsupported:
+        monkeypatch.setattr(os, method, fail, raising=False)
+    source = tmp_path / 'source.bin'
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    source.write_bytes(data)
+    os.chmod(str(source), 0o750)
+    destination = tmp_path / 'destination.bin'
+    destination.write_bytes(b'old contents that are longer than nothing')
+
+    pb_tool.copy_file(str(source), str(destination))
+    assert destination.read_bytes() == data
+    assert os.stat(str(destination)).st_mode & 0o777 == 0o750
+
+
+def test_kernel_copy_short(tmp_path, monkeypatch):
+    source = tmp_path / 'source.bin'
+    source.write_bytes(b'x' * 1000)
+    destination = tmp_path / 'destination.bin'
+    # a file system that copies nothing falls back to a buffered copy
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    pb_tool.copy_file(str(source), str(destination))
+    assert destination.read_bytes() == b'x' * 1000
+
+    # a source that stops short part way through is an error
+    sent = []
+    monkeypatch.setattr(os, 'copy_file_range',
+                        lambda *args: 0 if sent else sent.append(1) or 500,
+                        raising=False)
+    with pytest.raises(OSError):
+        pb_tool.copy_file(str(source), str(destination))
+
+
+def fake_tool(directory, name, script):
+    """ Put a shell script standing in for an external tool in directory """
+    path = os.path.join(str(directory), name)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n' + script)
+    os.chmod(path, 0o755)
+    return path
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='uses shell scripts')
+def test_compile_parallel_reports_failures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('compiled_ui_files:',
+                               'compiled_ui_files: a.ui bad.ui c.ui')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    for name in ('a.ui', 'bad.ui', 'c.ui'):
+        with open(name, 'w') as f:
+            f.write('<ui/>')
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake_tool(bin_dir, 'pyuic5', 'case "$3" in bad.ui) echo broken; exit 1;; esac\n'
+                                 'echo compiled > "$2"\n')
+    monkeypatch.setenv('PATH', str(bin_dir))
+    monkeypatch.setattr(pb_tool, 'load_uic', lambda: None)
+
+    result = runner.invoke(pb_tool.cli, ['compile', '-j', '3'])
+    assert result.exit_code == 1
+    assert 'Compiled 2 UI files' in result.output
+    assert 'Failed to compile bad.ui: broken' in result.output
+    assert os.path.exists('a.py') and os.path.exists('c.py')
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='uses shell scripts')
+def test_find_tools(tmp_path, monkeypatch):
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    pyrcc5 = fake_tool(second, 'pyrcc5', 'echo "Resource Compiler for Qt version 5.15.2"\n')
+    fake_tool(second, 'pyuic5', 'echo 5.15.9\n')
+    (first / 'pyuic5').write_text('not executable')
+    monkeypatch.setenv('PATH', os.pathsep.join([str(first), str(second)]))
+
+    tools = pb_tool.find_tools()
+    assert tools['pyrcc5'] == pyrcc5
+    assert tools['pyuic5'] == str(second / 'pyuic5')
+    assert tools['zip'] is None
+
+    # a second lookup comes from the cache without listing the PATH again
+    scanned = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir',
+                        lambda path: scanned.append(path) or real_scandir(path))
+    assert pb_tool.check_path('pyrcc5') == pyrcc5
+    assert scanned == []
+
+    # adding a tool to a PATH directory invalidates it
+    fake_tool(first, 'zip', 'echo "This is Zip 3.0 (July 5th 2008)"\n')
+    os.utime(str(first), ns=(0, 0))
+    assert pb_tool.check_path('zip') == str(first / 'zip')
+    assert scanned == [str(first), str(second)]
+
+    result = runner.invoke(pb_tool.cli, ['tools'])
+    assert 'Resource Compiler for Qt version 5.15.2' in result.output
+    assert 'This is Zip 3.0' in result.output
+    assert 'lrelease      not found' in result.output
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='uses shell scripts')
+def test_translations_incremental(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = str(tmp_path / 'plugins')
+    make_plugin(plugins)
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('locales:', 'locales: de fr.ts pt_BR')
+        cfg = cfg.replace('extra_dirs: data', 'extra_dirs: data i18n')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg + '[translations]\ncompiler: lrelease\n')
+    os.mkdir('i18n')
+    for locale in ('de', 'fr', 'pt_BR'):
+        with open(os.path.join('i18n', locale + '.ts'), 'w') as f:
+            f.write('<TS language="{0}"/>'.format(locale))
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake_tool(bin_dir, 'lrelease', 'case "$1" in -version) echo 5.15;; '
+                                   '*) cp "$1" "$3";; esac\n')
+    monkeypatch.setenv('PATH', os.pathsep.join([str(bin_dir), os.defpath]))
+    monkeypatch.setattr(pb_tool, 'load_uic', lambda: None)
+
+    result = runner.invoke(pb_tool.cli, ['translate', '-j', '3'])
+    assert result.exit_code == 0
+    assert 'Compiled 3 translation files' in result.output
+    assert os.path.exists(os.path.join('i18n', 'pt_BR.qm'))
+
+    result = runner.invoke(pb_tool.cli, ['translate'])
+    assert 'Compiled 0 translation files' in result.output
+
+    with open(os.path.join('i18n', 'fr.ts'), 'w') as f:
+        f.write('<TS language="fr" version="2"/>')
+    result = runner.invoke(pb_tool.cli, ['deploy', '-y'])
+    assert 'Compiling i18n/fr.ts to i18n/fr.qm' in result.output
+    assert 'Compiled 1 translation files' in result.output
+    with open(os.path.join(plugins, 'testplugin', 'i18n', 'fr.qm')) as f:
+        assert f.read() == '<TS language="fr" version="2"/>'
+    with open(os.path.join(plugins, 'testplugin',
+                           pb_tool.MANIFEST_NAME)) as f:
+        manifest = f.read()
+    assert manifest.count('"i18n/de.qm"') == 1
+
+
+TS = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE TS>
+<TS version="2.1" language="{language}">
+<context>
+    <name>TestPlugin</name>
+    <message>
+        <location filename="../plugin.py" line="10"/>
+        <source>&amp;Test Plugin</source>
+        <translation>{translation}</translation>
+    </message>
+    <message>
+        <source>Open</source>
+        <comment>verb</comment>
+        <translation>Bell<byte value="x7"/></translation>
+    </message>
+    <message>
+        <source>Not yet</source>
+        <translation type="unfinished"></translation>
+    </message>
+    <message>
+        <source>Gone</source>
+        <translation type="obsolete">Weg</translation>
+    </message>
+    <message numerus="yes">
+        <source>%n file(s)</source>
+        <translation>
+            <numerusform>%n Datei</numerusform>
+            <numerusform>%n Dateien</numerusform>
+        </translation>
+    </message>
+</context>
+</TS>
+"""
+
+
+def read_qm(path):
+    """ Return the sections of a .qm file and a lookup like QTranslator's """
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data[:16] == pb_tool.QM_MAGIC
+    sections = {}
+    pos = 16
+    while pos < len(data):
+        tag, length = struct.unpack('>BI', data[pos:pos + 5])
+        sections[tag] = data[pos + 5:pos + 5 + length]
+        pos += 5 + length
+    hashes = sections.get(0x42, b'')
+    table = [struct.unpack('>II', hashes[i:i + 8])
+             for i in range(0, len(hashes), 8)]
+    assert table == sorted(table)
+
+    def lookup(context, source, comment=''):
+        key = (source + comment).encode('utf-8')
+        for h, offset in table:
+            if h != pb_tool.elf_hash(key):
+                continue
+            messages = sections[0x69]
+            translations, fields = [], {}
+            while messages[offset] != 1:
+                tag, length = struct.unpack('>BI', messages[offset:offset + 5])
+                value = messages[offset + 5:offset + 5 + length]
+                offset += 5 + length
+                if tag == 3:
+                    translations.append(value.decode('utf-16-be'))
+                else:
+                    fields[tag] = value.decode('utf-8')
+            if fields == {7: context, 6: source, 8: comment}:
+                return translations
+        return None
+    return sections, lookup
+
+
+def test_compile_translations_builtin(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('locales:', 'locales: de ru ja')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    os.mkdir('i18n')
+    for language, translation in (('de_DE', '&amp;Test-Plugin'),
+                                  ('ru', 'Тест 😀'), ('ja', '')):
+        with open(os.path.join('i18n', language[:2] + '.ts'), 'w',
+                  encoding='utf-8') as f:
+            f.write(TS.format(language=language, translation=translation))
+    monkeypatch.setenv('PATH', str(tmp_path))
+
+    result = runner.invoke(pb_tool.cli, ['translate', '-j', '3'])
+    assert result.exit_code == 0
+    assert 'Compiled 3 translation files' in result.output
+
+    sections, lookup = read_qm(os.path.join('i18n', 'de.qm'))
+    assert sections[0xa7] == b'de_DE'
+    assert sections[0x88] == bytes([0x01, 1])
+    assert lookup('TestPlugin', '&Test Plugin') == ['&Test-Plugin']
+    assert lookup('TestPlugin', 'Open', 'verb') == ['Bell\x07']
+    assert lookup('TestPlugin', 'Open') is None
+    assert lookup('TestPlugin', 'Not yet') is None
+    assert lookup('TestPlugin', 'Gone') is None
+    assert lookup('TestPlugin', '%n file(s)') == ['%n Datei', '%n Dateien']
+
+    sections, lookup = read_qm(os.path.join('i18n', 'ru.qm'))
+    assert lookup('TestPlugin', '&Test Plugin') == ['Тест 😀']
+    assert len(sections[0x88]) == 13
+    # Japanese has a single plural form, so there are no rules
+    sections, lookup = read_qm(os.path.join('i18n', 'ja.qm'))
+    assert 0x88 not in sections
+    assert lookup('TestPlugin', '&Test Plugin') == ['']
+
+
+def test_compile_ui_in_process(tmp_path, monkeypatch):
+    class FakeUic:
+        calls = []
+
+        @classmethod
+        def compileUi(cls, source, output):
+            cls.calls.append(source)
+            output.write('# compiled from {}\n'.format(source))
+
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('compiled_ui_files:', 'compiled_ui_files: a.ui')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    with open('a.ui', 'w') as f:
+        f.write('<ui/>')
+    monkeypatch.setenv('PATH', str(tmp_path))
+    monkeypatch.setattr(pb_tool, 'load_uic', lambda: FakeUic)
+
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 UI files' in result.output
+    assert FakeUic.calls == ['a.ui']
+    with open('a.py') as f:
+        assert f.read() == '# compiled from a.ui\n'
+
+
+def read_resource(module, path):
+    """ Look path up in a compiled resource module the way QResource does """
+    literals = {node.targets[0].id: ast.literal_eval(node.value)
+                for node in ast.parse(module).body
+                if isinstance(node, ast.Assign)
+                and isinstance(node.value, ast.Constant)}
+    tree = literals['qt_resource_struct_v2']
+    names = literals['qt_resource_name']
+    data = literals['qt_resource_data']
+
+    def name(offset):
+        (length,) = struct.unpack('>H', names[offset:offset + 2])
+        return names[offset + 6:offset + 6 + length * 2].decode('utf-16-be')
+
+    node = 0
+    for part in path.split('/'):
+        flags, count, first = struct.unpack(
+            '>HII', tree[node * 22 + 4:node * 22 + 14])
+        assert flags & 0x02
+        children = range(first, first + count)
+        node = [child for child in children
+                if name(struct.unpack('>I', tree[child * 22:child * 22 + 4])[0])
+                == part][0]
+    flags, offset = struct.unpack('>H4xI', tree[node * 22 + 4:node * 22 + 14])
+    (size,) = struct.unpack('>I', data[offset:offset + 4])
+    payload = data[offset + 4:offset + 4 + size]
+    return zlib.decompress(payload[4:]) if flags & 0x01 else payload
+
+
+def test_compile_resources_builtin(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('resource_files:', 'resource_files: resources.qrc')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    os.makedirs(os.path.join('icons', 'sub'))
+    text = b'hello world ' * 500
+    noise = os.urandom(4096)
+    with open(os.path.join('icons', 'text.txt'), 'wb') as f:
+        f.write(text)
+    with open(os.path.join('icons', 'sub', 'noise.bin'), 'wb') as f:
+        f.write(noise)
+    with open('resources.qrc', 'w') as f:
+        f.write('<RCC><qresource prefix="/plugins/testplugin">'
+                '<file>icons/text.txt</file>'
+                '<file alias="noise.bin">icons/sub/noise.bin</file>'
+                '</qresource></RCC>')
+
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 resource files' in result.output
+    with open('resources.py') as f:
+        module = f.read()
+    assert module.count('qt_resource_struct_v') == 4
+    assert read_resource(module, 'plugins/testplugin/icons/text.txt') == text
+    assert read_resource(module, 'plugins/testplugin/noise.bin') == noise
+
+
+def test_compile_resources_when_listed_file_changes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('resource_files:', 'resource_files: resources.qrc')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    with open('icon.svg', 'w') as f:
+        f.write('<svg/>')
+    with open('resources.qrc', 'w') as f:
+        f.write('<RCC><qresource><file>icon.svg</file></qresource></RCC>')
+
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 resource files' in result.output
+    assert os.path.exists(os.path.join('.pb_tool_cache', 'qrc_deps.json'))
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Skipping resources.qrc (unchanged)' in result.output
+
+    mtime = os.stat('resources.py').st_mtime + 10
+    os.utime('icon.svg', (mtime, mtime))
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 resource files' in result.output
+
+    # files added to a listed directory are dependencies too
+    os.makedirs(os.path.join('icons', 'sub'))
+    with open('resources.qrc', 'w') as f:
+        f.write('<RCC><qresource><file>icons</file></qresource></RCC>')
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 resource files' in result.output
+    with open(os.path.join('icons', 'sub', 'new.svg'), 'w') as f:
+        f.write('<svg/>')
+    # resources.py is newer than the .qrc but older than the new file
+    mtime = (os.stat('resources.qrc').st_mtime_ns + os.stat(
+        os.path.join('icons', 'sub', 'new.svg')).st_mtime_ns) // 2
+    os.utime('resources.py', ns=(mtime, mtime))
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 resource files' in result.output
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Skipping resources.qrc (unchanged)' in result.output
+
+
+def test_build_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    with open('pb_tool.cfg') as f:
+        cfg = f.read().replace('resource_files:', 'resource_files: resources.qrc')
+    with open('pb_tool.cfg', 'w') as f:
+        f.write(cfg)
+    with open('icon.svg', 'w') as f:
+        f.write('<svg/>')
+    with open('resources.qrc', 'w') as f:
+        f.write('<RCC><qresource><file>icon.svg</file></qresource></RCC>')
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Compiled 1 resource files' in result.output
+    with open('resources.py') as f:
+        compiled = f.read()
+
+    # a fresh checkout: same content, new modification times
+    os.unlink('resources.py')
+    os.utime('icon.svg')
+    result = runner.invoke(pb_tool.cli, ['compile'])
+    assert 'Restored resources.py from the build cache' in result.output
+    with open('resources.py') as f:
+        assert f.read() == compiled
+
+    result = runner.invoke(pb_tool.cli, ['cache', 'stats'])
+    assert 'Entries: 1' in result.output
+    result = runner.invoke(pb_tool.cli, ['cache', 'prune', '--all'])
+    assert 'Removed 1 entries' in result.output
+
+
+def test_build_cache_identity_is_lazy(tmp_path):
+    calls = []
+    cache = pb_tool.BuildCache(str(tmp_path / 'cache'), 1024 * 1024)
+    compiler = cache.wrap(lambda source, output: None,
+                          lambda: calls.append(1) or 'tool 1.0')
+    # nothing outdated: the tool isn't asked for its version
+    assert pb_tool.run_compilers(compiler, [], 'UI') == []
+    assert calls == []
+
+    source = tmp_path / 'form.ui'
+    source.write_text('<ui/>')
+    output = tmp_path / 'form.py'
+    output.write_text('# compiled\n')
+    assert compiler(str(source), str(output)) is None
+    assert calls == [1]
+    assert [name for root, dirs, files in os.walk(str(tmp_path / 'cache'))
+            for name in files] == [os.path.basename(cache.entries()[0][0])]
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_watchers_report_changes(tmp_path, monkeypatch, inotify):
+    if inotify and not sys.platform.startswith('linux'):
+        pytest.skip('inotify is Linux only')
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    files, trees = pb_tool.watched_paths(pb_tool.Project())
+    if inotify:
+        watcher = pb_tool.InotifyWatcher(files, trees)
+    else:
+        watcher = pb_tool.PollingWatcher(files, trees, 0.05)
+    try:
+        with open('plugin.py', 'w') as f:
+            f.write('# changed\n')
+        os.makedirs(os.path.join('data', 'new'))
+        assert watcher.wait(1) == {'plugin.py'}
+        with open(os.path.join('data', 'new', 'more.csv'), 'w') as f:
+            f.write('x,y\n')
+        with open('unrelated.txt', 'w') as f:
+            f.write('not deployed\n')
+        assert watcher.wait(1) == {os.path.join('data', 'new', 'more.csv')}
+    finally:
+        watcher.close()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='uses make')
+def test_doc_skipped_when_unchanged(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('help', 'source'))
+    with open(os.path.join('help', 'Makefile'), 'w') as f:
+        f.write('html:\n\tmkdir -p build/html\n'
+                '\tcp source/index.rst build/html/index.html\n')
+    with open(os.path.join('help', 'source', 'index.rst'), 'w') as f:
+        f.write('Help\n====\n')
+    # without Sphinx in this environment make is used
+    monkeypatch.setitem(sys.modules, 'sphinx.cmd.build', None)
+
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Building the help documentation' in result.output
+    assert os.path.exists(os.path.join('help', 'build', 'html', 'index.html'))
+    assert os.getcwd() == str(tmp_path)
+
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Skipping the help documentation (unchanged)' in result.output
+
+    with open(os.path.join('help', 'source', 'index.rst'), 'a') as f:
+        f.write('More help\n')
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Building the help documentation' in result.output
+    result = runner.invoke(pb_tool.cli, ['doc', '--force'])
+    assert 'Building the help documentation' in result.output
+
+
+def test_doc_sphinx_in_process(tmp_path, monkeypatch):
+    calls = []
+
+    def build_main(argv):
+        calls.append(argv)
+        os.makedirs(argv[-1])
+        return 0
+
+    build = type(sys)('sphinx.cmd.build')
+    build.build_main = build_main
+    monkeypatch.setitem(sys.modules, 'sphinx.cmd.build', build)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('help', 'source'))
+    with open(os.path.join('help', 'source', 'conf.py'), 'w') as f:
+        f.write('project = "test"\n')
+
+    result = runner.invoke(pb_tool.cli, ['doc', '-j', '4'])
+    assert result.exit_code == 0
+    assert calls == [['-b', 'html',
+                      '-d', os.path.join('help', 'build', 'doctrees'),
+                      '-j', '4', os.path.join('help', 'source'),
+                      os.path.join('help', 'build', 'html')]]
+    runner.invoke(pb_tool.cli, ['doc'])
+    assert len(calls) == 1
+
+    # from another thread (a workspace build) Sphinx gets its own process,
+    # as it changes the current directory
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+    commands = []
+    monkeypatch.setattr(subprocess, 'run', lambda command, **kwargs:
+                        commands.append(command) or
+                        subprocess.CompletedProcess(command, 0, ''))
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert pool.submit(pb_tool.build_docs, force=True).result()
+    assert len(calls) == 1
+    assert commands[0][:3] == [sys.executable, '-m', 'sphinx']
+
+
+def test_doc_without_source_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(sys.modules, 'sphinx.cmd.build', None)
+    os.makedirs('help')
+    with open(os.path.join('help', 'Makefile'), 'w') as f:
+        f.write('html:\n\tmkdir -p build/html\n'
+                '\tcp index.rst build/html/index.html\n')
+    with open(os.path.join('help', 'index.rst'), 'w') as f:
+        f.write('Help\n====\n')
+
+    # sources kept in help itself are what is fingerprinted
+    with open(os.path.join('help', 'conf.py'), 'w') as f:
+        f.write('project = "test"\n')
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Building the help documentation' in result.output
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Skipping the help documentation (unchanged)' in result.output
+    with open(os.path.join('help', 'index.rst'), 'a') as f:
+        f.write('More help\n')
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Building the help documentation' in result.output
+
+    # without a conf.py it is always built
+    os.unlink(os.path.join('help', 'conf.py'))
+    runner.invoke(pb_tool.cli, ['doc'])
+    result = runner.invoke(pb_tool.cli, ['doc'])
+    assert 'Building the help documentation' in result.output
+
+
 def test_zip():
     result = runner.invoke(pb_tool.cli, ['zip'], input='y\n')
     assert result.exit_code == 0
     #assert os.path.exists(os.path.join(os.getcwd(), 'whereami.zip'))
 
 
+def test_zip_from_source(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plugins = tmp_path / 'plugins'
+    make_plugin(str(plugins))
+    make_help()
+    result = runner.invoke(pb_tool.cli, ['zip', '-q', '--level', '9'])
+    assert result.exit_code == 0
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        assert sorted(archive.namelist()) == [
+            'testplugin/__init__.py', 'testplugin/data/sub/points.csv',
+            'testplugin/help/index.html', 'testplugin/metadata.txt',
+            'testplugin/plugin.py']
+        assert archive.read('testplugin/data/sub/points.csv') == b'x,y\n1,2\n'
+    # packaging doesn't deploy
+    assert not plugins.exists()
+
+
+def test_zip_parallel_stores_compressed_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    make_help()
+    contents = {
+        'data/icon.png': os.urandom(1000),
+        'data/raster.tif': os.urandom(2 * 1024 * 1024),
+        'data/table.csv': b'1,2,3\n' * 100000,
+    }
+    for path, data in contents.items():
+        with open(path, 'wb') as f:
+            f.write(data)
+    result = runner.invoke(pb_tool.cli, ['zip', '-q', '-j', '4'])
+    assert result.exit_code == 0
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        assert archive.testzip() is None
+        assert archive.namelist()[0] == 'testplugin/__init__.py'
+        for path, data in contents.items():
+            info = archive.getinfo('testplugin/' + path)
+            assert archive.read(info) == data
+        assert archive.getinfo('testplugin/data/icon.png').compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo('testplugin/data/raster.tif').compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo('testplugin/data/table.csv').compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_zip_timestamp_before_1980(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    make_help()
+    os.utime('plugin.py', (0, 0))
+    for args in (['zip', '-q'], ['zip', '-q', '-r', '-f']):
+        result = runner.invoke(pb_tool.cli, args)
+        assert result.exit_code == 0
+        with zipfile.ZipFile('testplugin.zip') as archive:
+            assert archive.getinfo('testplugin/plugin.py').date_time[0] >= 1980
+
+
+def test_zip_writer_zip64(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    make_help()
+    with open(os.path.join('data', 'sub', 'n\u00e4me.csv'), 'w') as f:
+        f.write('x,y\n' * 1000)
+    # pretend the archive outgrows the classic limits
+    monkeypatch.setattr(pb_tool, 'ZIP64_LIMIT', 100)
+    monkeypatch.setattr(pb_tool, 'ZIP_MAX_FILES', 3)
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert result.exit_code == 0
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        assert archive.testzip() is None
+        assert len(archive.namelist()) == 6
+        assert archive.read('testplugin/data/sub/n\u00e4me.csv') == (
+            b'x,y\n' * 1000)
+        assert archive.comment.startswith(b'pb_tool:')
+
+
+def test_zip_reproducible_and_skip_unchanged(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1600000000')
+    make_plugin(str(tmp_path / 'plugins'))
+    make_help()
+    result = runner.invoke(pb_tool.cli, ['zip', '-q', '-r'])
+    assert 'has been created' in result.output
+    with open('testplugin.zip', 'rb') as f:
+        first = f.read()
+
+    result = runner.invoke(pb_tool.cli, ['zip', '-q', '-r'])
+    assert 'testplugin.zip is up to date' in result.output
+
+    os.utime('plugin.py', (0, 1700000000))
+    os.unlink('testplugin.zip')
+    result = runner.invoke(pb_tool.cli, ['zip', '-q', '-r'])
+    with open('testplugin.zip', 'rb') as f:
+        assert f.read() == first
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        names = archive.namelist()
+        assert names == sorted(names)
+        assert archive.getinfo(names[0]).date_time == (2020, 9, 13, 12, 26, 40)
+
+    with open('plugin.py', 'w') as f:
+        f.write('# changed\n')
+    result = runner.invoke(pb_tool.cli, ['zip', '-q', '-r'])
+    assert 'has been created' in result.output
+
+
+def test_zip_missing_file_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_plugin(str(tmp_path / 'plugins'))
+    make_help()
+    os.unlink('plugin.py')
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert result.exit_code == 1
+    assert 'ERRORS' in result.output
+    with zipfile.ZipFile('testplugin.zip') as archive:
+        assert archive.comment == b''
+    # the incomplete archive is rebuilt rather than reported as up to date
+    result = runner.invoke(pb_tool.cli, ['zip', '-q'])
+    assert result.exit_code == 1
+    assert 'up to date' not in result.output
+
+
 def test_dclean():
     result = runner.invoke(pb_tool.cli, ['dclean'], input='y\n')
     assert result.exit_code == 0